@@ -0,0 +1,141 @@
+"""
+Peak memory benchmark of the pandas handoff in `Synthesizer` on a wide dataset.
+Every measurement runs in a fresh process, which reads the dataset and fits a synthesizer, so its peak
+resident set size only contains that fit.
+Run from the repository root with `python -m benchmarks.benchmark_memory`.
+"""
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import sdv.metadata
+
+from src.modeling.constraints import ConstraintLayer
+from src.modeling.numpy_copula import NumpyGaussianCopulaSynthesizer
+from src.modeling.synthetization import Synthesizer
+
+PRIMARY_KEY = "Patient ID"
+CONSTRAINTS = [
+    {
+        "constraint_class": "Inequality",
+        "constraint_parameters": {
+            "low_column_name": "Blutdruck, diastolischM",
+            "high_column_name": "Blutdruck, systolischM",
+            "strict_boundaries": True,
+        },
+    }
+]
+
+
+def generate_data(number_of_patients: int, number_of_peptides: int, seed: int = 0) -> pl.DataFrame:
+    """
+    generate a joined clinical and peptide table shaped like the modelled HF data
+    Args:
+        number_of_patients: number of rows
+        number_of_peptides: number of peptide columns
+        seed: seed of the random number generator
+    Returns: table with the primary key, a few clinical columns and the peptides
+    """
+    rng = np.random.default_rng(seed)
+    diastolic = rng.normal(80, 10, size=number_of_patients).round(1)
+    clinical = pl.DataFrame(
+        {
+            PRIMARY_KEY: np.arange(number_of_patients),
+            "Age": rng.integers(18, 90, size=number_of_patients),
+            "Blutdruck, diastolischM": diastolic,
+            "Blutdruck, systolischM": diastolic + rng.exponential(40, size=number_of_patients).round(1) + 0.1,
+        }
+    )
+    peptides = pl.DataFrame(
+        rng.lognormal(1, 1, size=(number_of_patients, number_of_peptides)),
+        schema=[f"p{i}" for i in range(number_of_peptides)],
+    )
+    return pl.concat([clinical, peptides], how="horizontal")
+
+
+def fit_with_repeated_conversions(original_data: pl.DataFrame, peptides: list[str]) -> None:
+    """reference handoff converting the real data to pandas for the metadata and again for the fit"""
+    metadata = sdv.metadata.SingleTableMetadata()
+    metadata.detect_from_dataframe(original_data.to_pandas())
+    for column in peptides:
+        metadata.update_column(column, sdtype="numerical")
+    layer = ConstraintLayer(CONSTRAINTS)
+    model = NumpyGaussianCopulaSynthesizer(metadata=metadata, default_distribution="norm")
+    data = original_data.to_pandas()
+    model.fit(layer.fit_transform(data.copy()))
+
+
+def fit_with_shared_conversion(original_data: pl.DataFrame, peptides: list[str]) -> None:
+    synthesizer = Synthesizer(
+        original_data,
+        PRIMARY_KEY,
+        peptides,
+        CONSTRAINTS,
+        sdv_synthesizer=NumpyGaussianCopulaSynthesizer,
+        random_seed=0,
+        default_distribution="norm",
+    )
+    synthesizer.fit()
+
+
+def measure(path: str, handoff: str) -> None:
+    """fit a synthesizer in this process and print the peak resident set size in MB and the time"""
+    original_data = pl.read_parquet(path)
+    peptides = [col for col in original_data.columns if col.startswith("p")]
+    loaded = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    start = time.perf_counter()
+    fit = fit_with_repeated_conversions if handoff == "repeated" else fit_with_shared_conversion
+    fit(original_data, peptides)
+    elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{loaded:.1f} {peak:.1f} {elapsed:.3f}")
+
+
+def run(path: str, handoff: str) -> tuple[float, float]:
+    """
+    measure a handoff in a fresh process
+    Returns: increase of the peak resident set size by the fit in MB and its time in seconds
+    """
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.benchmark_memory", path, handoff],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    loaded, peak, elapsed = map(float, output.split("\n")[-2].split())
+    return peak - loaded, elapsed
+
+
+def main():
+    number_of_patients = 20_000
+    print(
+        f"{'peptides':>10} {'table [MB]':>11} {'repeated peak RSS [MB]':>23} {'shared peak RSS [MB]':>21}"
+        f" {'repeated [s]':>13} {'shared [s]':>11}"
+    )
+    with tempfile.TemporaryDirectory() as directory:
+        for number_of_peptides in [500, 1_000, 2_000]:
+            data = generate_data(number_of_patients, number_of_peptides)
+            path = str(Path(directory, f"wide_{number_of_peptides}.parquet"))
+            data.write_parquet(path)
+
+            repeated_peak, repeated_time = run(path, "repeated")
+            shared_peak, shared_time = run(path, "shared")
+            print(
+                f"{number_of_peptides:>10} {data.estimated_size() / 2**20:>11.1f}"
+                f" {repeated_peak:>23.1f} {shared_peak:>21.1f}"
+                f" {repeated_time:>13.3f} {shared_time:>11.3f}"
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        measure(*sys.argv[1:])
+    else:
+        main()
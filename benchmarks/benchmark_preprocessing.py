@@ -0,0 +1,116 @@
+"""
+Scaling benchmark of the valid id intersection in `HFProcessorForSynthetization.preprocess_data`.
+Run from the repository root with `python -m benchmarks.benchmark_preprocessing`.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+import polars as pl
+
+from src.data.data_models import Data
+from src.data.data_processing import HFProcessorForSynthetization
+
+PRIMARY_KEY = "Patient ID"
+
+
+def generate_data(number_of_patients: int, number_of_peptides: int, seed: int = 0) -> Data:
+    """
+    generate raw clinical and peptide tables shaped like the HF dataset
+    Around 1% of the clinical and peptide rows contain a null value and the peptide table holds
+    a shuffled 90% of the patients, so the id intersection has real work to do.
+    Args:
+        number_of_patients: number of rows of the clinical table
+        number_of_peptides: number of peptide columns
+        seed: seed of the random number generator
+    Returns: raw (not preprocessed) data
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(number_of_patients)
+
+    clinical_values = rng.normal(100, 10, size=number_of_patients)
+    clinical_values[rng.random(number_of_patients) < 0.01] = np.nan
+    clinical = pl.DataFrame(
+        {
+            "": ids,
+            PRIMARY_KEY: ids,
+            "Age": rng.integers(18, 90, size=number_of_patients),
+            "BMI": clinical_values,
+        }
+    ).with_columns(pl.col("BMI").fill_nan(None))
+
+    peptide_ids = rng.permutation(ids)[: int(number_of_patients * 0.9)]
+    peptide_values = rng.exponential(10, size=(len(peptide_ids), number_of_peptides))
+    peptide_values[rng.random(peptide_values.shape) < 0.5] = 0.0
+    peptide_values[rng.random(len(peptide_ids)) < 0.01, 0] = np.nan
+    peptides = pl.DataFrame(
+        peptide_values, schema=[f"p{i}" for i in range(number_of_peptides)]
+    ).fill_nan(None)
+    peptides = peptides.insert_column(0, pl.Series(PRIMARY_KEY, peptide_ids * 1000))
+
+    return Data(clinical=clinical, peptides=peptides)
+
+
+def preprocess_with_python_sets(processor: HFProcessorForSynthetization, data: Data) -> Data:
+    """reference implementation intersecting the valid ids as python sets"""
+    data = processor._preprocess_clinical_data(data)
+    data = processor._preprocess_peptide_data(data)
+    valid_clinical_ids = data.clinical.drop_nulls()[PRIMARY_KEY].to_list()
+    valid_peptides_ids = data.peptides.drop_nulls()[PRIMARY_KEY].to_list()
+    valid_ids = set(valid_clinical_ids).intersection(set(valid_peptides_ids))
+    data.clinical = data.clinical.filter(pl.col(PRIMARY_KEY).is_in(valid_ids))
+    data.peptides = data.peptides.filter(pl.col(PRIMARY_KEY).is_in(valid_ids))
+    return data
+
+
+def time_call(function, repeats: int = 3) -> tuple[float, float, Data]:
+    """
+    measure a preprocessing function
+    Args:
+        function: function returning preprocessed data
+        repeats: number of timed calls
+    Returns: best wall clock time in seconds, peak python heap in MB and the last result
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+
+    # python objects created by the call (polars buffers live outside of the python heap)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak / 2**20, result
+
+
+def main():
+    processor = HFProcessorForSynthetization(PRIMARY_KEY)
+    number_of_peptides = 20
+
+    print(
+        f"{'patients':>10} {'python sets [s]':>16} {'semi-join [s]':>14} {'speedup':>8}"
+        f" {'python sets heap [MB]':>22} {'semi-join heap [MB]':>20}"
+    )
+    for number_of_patients in [10_000, 100_000, 1_000_000, 5_000_000]:
+        raw = generate_data(number_of_patients, number_of_peptides)
+
+        def copy_raw() -> Data:
+            return Data(clinical=raw.clinical.clone(), peptides=raw.peptides.clone())
+
+        set_time, set_heap, expected = time_call(
+            lambda: preprocess_with_python_sets(processor, copy_raw())
+        )
+        join_time, join_heap, result = time_call(lambda: processor.preprocess_data(copy_raw()))
+
+        assert result.clinical.equals(expected.clinical)
+        assert result.peptides.equals(expected.peptides)
+        print(
+            f"{number_of_patients:>10} {set_time:>16.3f} {join_time:>14.3f} {set_time / join_time:>7.1f}x"
+            f" {set_heap:>22.1f} {join_heap:>20.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
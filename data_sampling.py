@@ -0,0 +1,144 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from src.data.data_models import Data, PostprocessingStatistics, Processor
+from src.modeling.synthetization import Synthesizer
+from src.data.data_merge_and_save import SyntheticDataWriter, merge_and_save
+
+
+def sample_group(
+    synthesizer: Synthesizer,
+    data: Data,
+    remaining_peptides: list[str],
+    number_of_synth_samples: int,
+    batch_size: int,
+    processor: Processor,
+    rng: np.random.Generator,
+    writer: SyntheticDataWriter | None = None,
+    sampling_shard_size: int | None = None,
+    sampling_workers: int = 1,
+    statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
+) -> Data | None:
+    """
+    sample and postprocess a group of synthetic patients
+    Args:
+        synthesizer: fitted synthesizer of the group
+        data: original data of the group, only its columns are used if `statistics` are given
+        remaining_peptides: peptides which were not modeled using copulas due to not enough examples
+        number_of_synth_samples: number of synthetic patients
+        batch_size: generate data in batches of this size
+        processor: processor postprocessing the synthetic data
+        rng: random number generator used for imputation
+        writer: if given, batches are appended to its output files as soon as they are sampled
+        sampling_shard_size: if given, patients are sampled in shards of this size by worker processes
+        sampling_workers: number of processes sampling shards
+        statistics: statistics of the remaining peptides, computed from `data` if None
+
+    Returns: postprocessed synthetic group, None if it was written by `writer`
+    """
+    if sampling_shard_size:
+        # shards are sampled by worker processes from streams spawned from the random seed
+        synthetic_batches = synthesizer.sample_shards(
+            number_of_synth_samples, sampling_shard_size, sampling_workers, batch_size
+        )
+    else:
+        synthetic_batches = synthesizer.sample_batches(number_of_synth_samples, batch_size)
+
+    if writer is not None:
+        for batch in processor.postprocess_batches(data, remaining_peptides, synthetic_batches, rng, statistics):
+            writer.write(batch)
+        return None
+
+    # sample
+    if sampling_shard_size:
+        synthetic_data = pd.concat(list(synthetic_batches), ignore_index=True)
+    else:
+        synthetic_data = synthesizer.sample(number_of_synth_samples, batch_size)
+
+    return processor.postprocess_data(data, remaining_peptides, synthetic_data, rng, statistics)
+
+
+def save_groups(
+    synth_df: list[Data],
+    writer: SyntheticDataWriter | None,
+    primary_key: str,
+    save_path: str,
+) -> None:
+    """
+    merge and save the synthetic groups, or close the writer they were already written to
+    Args:
+        synth_df: postprocessed synthetic groups
+        writer: writer used for streaming sampling, if any
+        primary_key: primary key column name
+        save_path: path to directory where data will be saved
+    """
+    if writer is not None:
+        writer.close()
+        return
+
+    clinical_data_list = [data.clinical for data in synth_df]
+    peptides_data_list = [data.peptides for data in synth_df]
+    merge_and_save(clinical_data_list, peptides_data_list, primary_key, Path(save_path))
+
+
+def group_paths(model_path: str | Path) -> list[Path]:
+    """directories of the synthesizers saved by `data_synthesis`, ordered by group"""
+    return sorted(Path(model_path).glob("group_*"), key=lambda path: int(path.name.split("_")[-1]))
+
+
+def data_sampling(
+    model_path: str,
+    save_path: str,
+    number_of_synth_samples: list[int],
+    batch_size: int,
+    processor: Processor,
+    random_seed: int | None = None,
+    streaming_sampling: bool = False,
+    sampling_shard_size: int | None = None,
+    sampling_workers: int = 1,
+):
+    """
+    generate synthetic data from synthesizers saved by `data_synthesis`, without loading or fitting real data
+    Args:
+        model_path: directory with one saved synthesizer per group of patients
+        save_path: path to directory where data will be saved
+        number_of_synth_samples: number of synthetic patients of every group
+        batch_size: generate data in batches of this size
+        processor: processor postprocessing the synthetic data
+        random_seed: seed of the imputation of peptides which were not modeled
+        streaming_sampling: if True, batches are postprocessed and written as soon as they are sampled
+        sampling_shard_size: if given, patients are sampled in shards of this size by worker processes
+        sampling_workers: number of processes sampling shards
+    """
+    paths = group_paths(model_path)
+    if not paths:
+        raise FileNotFoundError(f"No saved synthesizers found in '{model_path}'.")
+
+    # same generators as in data_synthesis, so the imputation matches the run which saved the models
+    rngs = [np.random.default_rng(seed) for seed in np.random.SeedSequence(random_seed).spawn(len(paths))]
+    postprocessing = [PostprocessingStatistics.load(path / "postprocessing.json") for path in paths]
+    primary_key = postprocessing[0].primary_key
+
+    synth_df = []
+    writer = SyntheticDataWriter(primary_key, Path(save_path)) if streaming_sampling else None
+    for i, group_path in enumerate(paths):
+        print(f"Loading synthesizer from {group_path}...")
+        synthesizer = Synthesizer.load(group_path)
+        synthetic_group = sample_group(
+            synthesizer,
+            postprocessing[i].to_data(),
+            postprocessing[i].remaining_peptides,
+            number_of_synth_samples[i],
+            batch_size,
+            processor,
+            rngs[i],
+            writer,
+            sampling_shard_size,
+            sampling_workers,
+            postprocessing[i].statistics,
+        )
+        if synthetic_group is not None:
+            synth_df.append(synthetic_group)
+
+    save_groups(synth_df, writer, primary_key, save_path)
@@ -1,13 +1,15 @@
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import polars as pl
+from data_sampling import sample_group, save_groups
 from src.data.data_loader import DataLoader
-from src.data.data_models import Processor
+from src.data.data_models import Data, PostprocessingStatistics, Processor
 from src.modeling.distribution_modeling import DistributionEstimator
-from src.modeling.synthetization import Synthesizer
-from src.modeling.custom_copula_synthesizer import CustomGaussianCopulaSynthesizer
-from src.data.data_merge_and_save import merge_and_save
+from src.modeling.metadata import SchemaMetadataBuilder
+from src.modeling.synthetization import SYNTHESIZER_ENGINES, Synthesizer
+from src.data.data_merge_and_save import SyntheticDataWriter
 
 
 def data_synthesis(
@@ -26,68 +28,285 @@ def data_synthesis(
     random_seed: int | None = None,
     clinical_columns_to_estimate: list[str] | None = None,
     number_of_original_samples: int | None = None,
+    cache_dir: str | None = None,
+    streaming: bool = False,
+    sparse: bool = False,
+    fitting_workers: int | None = 1,
+    fitting_chunk_size: int = 16,
+    batched_fitting: bool = False,
+    fit_cache_dir: str | None = None,
+    fit_cache_size: int = 100_000,
+    fit_subsample_size: int | None = None,
+    fit_subsample_rounds: int = 5,
+    synthesizer_engine: str = "sdv",
+    copula_factors: int = 10,
+    copula_block_size: int = 500,
+    copula_workers: int = 1,
+    streaming_sampling: bool = False,
+    sampling_shard_size: int | None = None,
+    sampling_workers: int = 1,
+    model_path: str | None = None,
+    quantile_table_tolerance: float | None = None,
 ):
-    distribution_estimator = DistributionEstimator(
-        primary_key, distribution_list, fit_distribution_method
+    group_jobs = prepare_groups(
+        peptide_data_path,
+        clinical_data_path,
+        missing_threshold,
+        primary_key,
+        distribution_list,
+        fit_distribution_method,
+        filters,
+        number_of_synth_samples,
+        batch_size,
+        constraints,
+        processor,
+        random_seed,
+        clinical_columns_to_estimate,
+        number_of_original_samples,
+        cache_dir,
+        streaming,
+        sparse,
+        fitting_workers,
+        fitting_chunk_size,
+        batched_fitting,
+        fit_cache_dir,
+        fit_cache_size,
+        fit_subsample_size,
+        fit_subsample_rounds,
+        synthesizer_engine,
+        copula_factors,
+        copula_block_size,
+        copula_workers,
+        sampling_shard_size,
+        sampling_workers,
+        model_path,
+        quantile_table_tolerance,
     )
+
     synth_df = []
-    for i, filter_dict in enumerate(filters):
-        loader = DataLoader(
-            clinical_data_path,
-            peptide_data_path,
-            primary_key,
-            number_of_original_samples,
-            processor,
-            filter_dict,
-        )
-        print("Loading data...")
-        data = loader.get_data()
-        # find peptides that have at least 30% non-zero values
-        print("Getting peptides for modelling...")
-        peptides_to_model, low_count_peptides = processor.get_peptides_for_modelling(
-            data.peptides, missing_threshold
+    # with streaming sampling batches are appended to the output files as soon as they are sampled
+    writer = SyntheticDataWriter(primary_key, Path(save_path)) if streaming_sampling else None
+    for group_job in group_jobs:
+        synthetic_group = synthesize_group(**group_job, writer=writer)
+        if synthetic_group is not None:
+            synth_df.append(synthetic_group)
+
+    save_groups(synth_df, writer, primary_key, save_path)
+
+
+def prepare_groups(
+    peptide_data_path: str,
+    clinical_data_path: str,
+    missing_threshold: float,
+    primary_key: str,
+    distribution_list: list[str],
+    fit_distribution_method: str,
+    filters: list[dict],
+    number_of_synth_samples: list[int],
+    batch_size: int,
+    constraints: list[dict[str, Any]],
+    processor: Processor | None = None,
+    random_seed: int | None = None,
+    clinical_columns_to_estimate: list[str] | None = None,
+    number_of_original_samples: int | None = None,
+    cache_dir: str | None = None,
+    streaming: bool = False,
+    sparse: bool = False,
+    fitting_workers: int | None = 1,
+    fitting_chunk_size: int = 16,
+    batched_fitting: bool = False,
+    fit_cache_dir: str | None = None,
+    fit_cache_size: int = 100_000,
+    fit_subsample_size: int | None = None,
+    fit_subsample_rounds: int = 5,
+    synthesizer_engine: str = "sdv",
+    copula_factors: int = 10,
+    copula_block_size: int = 500,
+    copula_workers: int = 1,
+    sampling_shard_size: int | None = None,
+    sampling_workers: int = 1,
+    model_path: str | None = None,
+    quantile_table_tolerance: float | None = None,
+) -> list[dict[str, Any]]:
+    """
+    load a dataset and estimate the marginals shared by its groups, see `data_synthesis` for the arguments
+    Returns: keyword arguments of `synthesize_group` for every group, groups do not depend on each other
+    """
+    distribution_estimator = DistributionEstimator(
+        primary_key,
+        distribution_list,
+        fit_distribution_method,
+        n_workers=fitting_workers,
+        column_chunk_size=fitting_chunk_size,
+        batched=batched_fitting,
+        cache_dir=fit_cache_dir,
+        cache_size=fit_cache_size,
+        subsample_size=fit_subsample_size,
+        subsample_rounds=fit_subsample_rounds,
+        subsample_seed=random_seed if random_seed is not None else 0,
+    )
+    loader = DataLoader(
+        clinical_data_path,
+        peptide_data_path,
+        primary_key,
+        number_of_original_samples,
+        processor,
+        cache_dir=cache_dir,
+        streaming=streaming,
+        sparse=sparse,
+    )
+    # the dataset is parsed and preprocessed once, filter groups are derived from it
+    print("Loading data...")
+    grouped_data = loader.get_grouped_data(filters)
+
+    # peptides are shared by all groups, so modelled peptides and their marginals are computed once
+    # find peptides that have at least 30% non-zero values
+    print("Getting peptides for modelling...")
+    peptides_to_model, low_count_peptides = processor.get_peptides_for_modelling(
+        grouped_data[0].peptides, missing_threshold
+    )
+
+    # estimate marginal distributions
+    print("Estimating marginal distributions...")
+    # peptides_to_model = peptides_to_model.select(peptides_to_model.columns[:5])
+    if sparse:
+        # non-zero values are read from the sparse matrix instead of the densified frame
+        peptide_distributions = distribution_estimator.estimate(
+            grouped_data[0].peptides.select(peptides_to_model.columns)
         )
+    else:
+        peptide_distributions = distribution_estimator.estimate(peptides_to_model)
+    # fitted marginal parameters are reused by the copula instead of fitting the peptides again
+    peptide_parameters = distribution_estimator.parameters
 
-        # estimate marginal distributions
-        print("Estimating marginal distributions...")
-        # peptides_to_model = peptides_to_model.select(peptides_to_model.columns[:5])
-        distributions = distribution_estimator.estimate(peptides_to_model)
+    # every group imputes with its own generator spawned from the seed, so groups can run in any order
+    rngs = [np.random.default_rng(seed) for seed in np.random.SeedSequence(random_seed).spawn(len(grouped_data))]
+    # options only understood by some of the copula engines
+    engine_options = {
+        "factor": {"n_factors": copula_factors},
+        "clustered": {
+            "peptide_columns": [col for col in peptides_to_model.columns if col != primary_key],
+            "max_block_size": copula_block_size,
+            "n_workers": copula_workers,
+        },
+    }.get(synthesizer_engine, {})
+    # types of the modelled peptides are taken from their schema once for all groups
+    metadata_builder = SchemaMetadataBuilder(
+        primary_key, peptides_to_model.drop(primary_key).collect_schema()
+    )
+    group_jobs = []
+    for i, data in enumerate(grouped_data):
+        distributions = dict(peptide_distributions)
         for clinical_column in clinical_columns_to_estimate:
             distributions[clinical_column] = (
                 distribution_estimator.estimate_single_column_distribution(
                     data.clinical[clinical_column]
                 )
             )
+        group_jobs.append({
+            "data": data,
+            "peptides_to_model": peptides_to_model,
+            "low_count_peptides": low_count_peptides,
+            "distributions": distributions,
+            "peptide_parameters": peptide_parameters,
+            "primary_key": primary_key,
+            "number_of_synth_samples": number_of_synth_samples[i],
+            "batch_size": batch_size,
+            "constraints": constraints,
+            "processor": processor,
+            "rng": rngs[i],
+            "random_seed": random_seed,
+            "synthesizer_engine": synthesizer_engine,
+            "engine_options": engine_options,
+            "metadata_builder": metadata_builder,
+            "quantile_table_tolerance": quantile_table_tolerance,
+            "sampling_shard_size": sampling_shard_size,
+            "sampling_workers": sampling_workers,
+            "group_path": Path(model_path, f"group_{i}") if model_path is not None else None,
+        })
+    return group_jobs
 
-        # merge clinical data with peptides_to_model
-        original_data: pl.DataFrame = data.clinical.join(
-            peptides_to_model, on=primary_key
-        )
 
-        # initialize synthesizer
-        peptides_to_model_names = [
-            col for col in peptides_to_model.columns if col != primary_key
-        ]
-
-        synthesizer = Synthesizer(
-            original_data=original_data,
-            primary_key=primary_key,
-            peptides_to_model=peptides_to_model_names,
-            sdv_synthesizer=CustomGaussianCopulaSynthesizer,
-            random_seed=random_seed,
-            numerical_distributions=distributions,
-            constraints=constraints,
-        )
+def synthesize_group(
+    data: Data,
+    peptides_to_model: pl.DataFrame,
+    low_count_peptides: list[str],
+    distributions: dict[str, str],
+    peptide_parameters: dict[str, dict[str, float]],
+    primary_key: str,
+    number_of_synth_samples: int,
+    batch_size: int,
+    constraints: list[dict[str, Any]],
+    processor: Processor,
+    rng: np.random.Generator,
+    random_seed: int | None = None,
+    synthesizer_engine: str = "sdv",
+    engine_options: dict[str, Any] | None = None,
+    metadata_builder: SchemaMetadataBuilder | None = None,
+    quantile_table_tolerance: float | None = None,
+    sampling_shard_size: int | None = None,
+    sampling_workers: int = 1,
+    group_path: Path | None = None,
+    writer: SyntheticDataWriter | None = None,
+) -> Data | None:
+    """
+    fit a synthesizer to a group of patients, then sample and postprocess it
+    Args:
+        data: preprocessed data of the group
+        peptides_to_model: peptides modelled by the copula, with the primary key column
+        low_count_peptides: peptides which are imputed instead of modelled
+        distributions: marginal distribution of every estimated column
+        peptide_parameters: fitted marginal parameters of the peptides
+        metadata_builder: builder of the metadata shared by the groups of the dataset
+        quantile_table_tolerance: if given, marginals are sampled from quantile tables with at most this error
+        group_path: if given, the fitted synthesizer is saved to this directory
+        writer: if given, batches are appended to its output files as soon as they are sampled
+        see `data_synthesis` for the other arguments
 
-        synthesizer.fit()
+    Returns: postprocessed synthetic group, None if it was written by `writer`
+    """
+    # merge clinical data with peptides_to_model
+    original_data: pl.DataFrame = data.clinical.join(
+        peptides_to_model, on=primary_key
+    )
 
-        # sample
-        synthetic_data = synthesizer.sample(number_of_synth_samples[i], batch_size)
+    # initialize synthesizer
+    peptides_to_model_names = [
+        col for col in peptides_to_model.columns if col != primary_key
+    ]
 
-        synth_df.append(
-            processor.postprocess_data(data, low_count_peptides, synthetic_data)
+    synthesizer = Synthesizer(
+        original_data=original_data,
+        primary_key=primary_key,
+        peptides_to_model=peptides_to_model_names,
+        sdv_synthesizer=SYNTHESIZER_ENGINES[synthesizer_engine],
+        random_seed=random_seed,
+        numerical_distributions=distributions,
+        fitted_parameters=peptide_parameters,
+        constraints=constraints,
+        metadata_builder=metadata_builder,
+        quantile_table_tolerance=quantile_table_tolerance,
+        **(engine_options or {}),
+    )
+
+    synthesizer.fit()
+
+    if group_path is not None:
+        # fitted groups can be sampled again without refitting, see `data_sampling`
+        synthesizer.save(group_path)
+        PostprocessingStatistics.from_data(data, low_count_peptides, primary_key).save(
+            group_path / "postprocessing.json"
         )
 
-    clinical_data_list = [data.clinical for data in synth_df]
-    peptides_data_list = [data.peptides for data in synth_df]
-    merge_and_save(clinical_data_list, peptides_data_list, primary_key, Path(save_path))
+    return sample_group(
+        synthesizer,
+        data,
+        low_count_peptides,
+        number_of_synth_samples,
+        batch_size,
+        processor,
+        rng,
+        writer,
+        sampling_shard_size,
+        sampling_workers,
+    )
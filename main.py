@@ -1,10 +1,10 @@
 import yaml
 from src.data.hf_data_merging import merge_hf_data
 from data_synthesis import data_synthesis
+from data_sampling import data_sampling
 from src.data.data_processing import HFProcessorForSynthetization
-from src.modeling.bootstrapping_results import bootstrapping_data
-from pathlib import Path
-import pandas as pd
+from src.modeling.bootstrapping_results import bootstrap_synthetic_data
+from synthesis_scheduler import SynthesisScheduler
 
 def load_config(config_file="configuration.yaml"):
     """
@@ -30,6 +30,8 @@ def main():
         merge_hf_data(
             initial_data_handling.get("root_dir_path"),
             initial_data_handling.get("save_dir_path"),
+            initial_data_handling.get("excel_cache_dir"),
+            initial_data_handling.get("excel_max_workers"),
         )
 
     filtering_ = synthesis.get("filtering")
@@ -55,82 +57,121 @@ def main():
     n_of_synth_samples = synthesis.get("number_of_synth_samples")
     clinical_columns_to_estimate = synthesis.get("clinical_columns_to_estimate")
     constraints = synthesis.get("constraints")
+    cache_dir = synthesis.get("preprocessed_data_cache_dir")
+    streaming = synthesis.get("streaming_peptides", False)
+    sparse = synthesis.get("sparse_peptides", False)
+    fitting_workers = synthesis.get("distribution_fitting_workers", 1)
+    fitting_chunk_size = synthesis.get("distribution_fitting_chunk_size", 16)
+    batched_fitting = synthesis.get("batched_distribution_fitting", False)
+    fit_cache_dir = synthesis.get("distribution_fit_cache_dir")
+    fit_cache_size = synthesis.get("distribution_fit_cache_size", 100_000)
+    fit_subsample_size = synthesis.get("distribution_fitting_subsample_size")
+    fit_subsample_rounds = synthesis.get("distribution_fitting_subsample_rounds", 5)
+    synthesizer_engine = synthesis.get("synthesizer_engine", "sdv")
+    copula_factors = synthesis.get("copula_factors", 10)
+    copula_block_size = synthesis.get("copula_block_size", 500)
+    copula_workers = synthesis.get("copula_workers", 1)
+    quantile_table_tolerance = synthesis.get("quantile_table_tolerance")
+    streaming_sampling = synthesis.get("streaming_sampling", False)
+    sampling_shard_size = synthesis.get("sampling_shard_size", None)
+    sampling_workers = synthesis.get("sampling_workers", 1)
+    model_paths = synthesis.get("model_paths")
+    sample_from_saved_models = synthesis.get("sample_from_saved_models", False)
+
+    scheduled_synthesis = synthesis.get("scheduled_synthesis", False)
+    scheduler_max_cpus = synthesis.get("scheduler_max_cpus")
+    scheduler_memory_limit = synthesis.get("scheduler_memory_limit_gb")
 
     processor = HFProcessorForSynthetization(primary_key=primary_key)
 
-    for i in range(len(peptide_data_paths)):
-        data_synthesis(
-            peptide_data_paths[i],
-            clinical_data_paths[i],
-            save_paths[i],
-            missing_threshold,
-            primary_key,
-            distribution_list,
-            fit_distr_method,
-            filters,
-            n_of_synth_samples[i],
-            batch_size,
-            constraints,
-            processor,
-            random_seed,
-            clinical_columns_to_estimate,
-            n_of_original_samples,
+    # arguments of data_synthesis shared by all datasets
+    synthesis_options = {
+        "missing_threshold": missing_threshold,
+        "primary_key": primary_key,
+        "distribution_list": distribution_list,
+        "fit_distribution_method": fit_distr_method,
+        "filters": filters,
+        "batch_size": batch_size,
+        "constraints": constraints,
+        "processor": processor,
+        "random_seed": random_seed,
+        "clinical_columns_to_estimate": clinical_columns_to_estimate,
+        "number_of_original_samples": n_of_original_samples,
+        "cache_dir": cache_dir,
+        "streaming": streaming,
+        "sparse": sparse,
+        "fitting_workers": fitting_workers,
+        "fitting_chunk_size": fitting_chunk_size,
+        "batched_fitting": batched_fitting,
+        "fit_cache_dir": fit_cache_dir,
+        "fit_cache_size": fit_cache_size,
+        "fit_subsample_size": fit_subsample_size,
+        "fit_subsample_rounds": fit_subsample_rounds,
+        "synthesizer_engine": synthesizer_engine,
+        "copula_factors": copula_factors,
+        "copula_block_size": copula_block_size,
+        "copula_workers": copula_workers,
+        "quantile_table_tolerance": quantile_table_tolerance,
+        "sampling_shard_size": sampling_shard_size,
+        "sampling_workers": sampling_workers,
+    }
+    bootstrapping_options = [
+        {
+            "peptide_data_path": peptide_data_paths[i],
+            "primary_key": primary_key,
+            "nonzero_threshold": bootstrapping_nonzero_threshold,
+            "sample_size": bootstrapping_sample_sizes[i],
+            "iteration_number": bootstrapping_iteration_number,
+        } if bootstrapping else None
+        for i in range(len(peptide_data_paths))
+    ]
+
+    if scheduled_synthesis and not sample_from_saved_models:
+        if streaming_sampling:
+            raise ValueError("Streaming sampling writes groups in order and cannot be used with scheduled synthesis.")
+        # every (dataset, group) pair is fitted and sampled by an independent task
+        datasets = [
+            {
+                **synthesis_options,
+                "peptide_data_path": peptide_data_paths[i],
+                "clinical_data_path": clinical_data_paths[i],
+                "number_of_synth_samples": n_of_synth_samples[i],
+                "model_path": model_paths[i] if model_paths else None,
+            }
+            for i in range(len(peptide_data_paths))
+        ]
+        SynthesisScheduler(scheduler_max_cpus, scheduler_memory_limit).run(
+            datasets, save_paths, bootstrapping_options
         )
-        if bootstrapping:
-            print(bootstrapping_nonzero_threshold)
-            print("#### Bootstrapping started ####")
-            path_to_synth_table = Path(save_paths[i], "synthetic_data_peptides.csv")
-            best_seed, statistic = bootstrapping_data(
-                path_to_synth_table,
-                peptide_data_paths[i],
-                bootstrapping_nonzero_threshold,
-                bootstrapping_sample_sizes[i],
-                bootstrapping_iteration_number
-            )
-            data = pd.read_csv(path_to_synth_table).sample(bootstrapping_sample_sizes[i], random_state=best_seed)
-
-            # Saving bootstrapped peptides data
-            print("#### Saving bootstrapped data ####")
-            data.to_csv(
-                Path(save_paths[i], "synthetic_data_peptides_bootstrapped.csv"),
-                header=True,
-                index=False
-            )
-
-            # select sample ids
-            sample_ids = data[primary_key]  # Adjust 'id' to match your actual column name for IDs
-
-            # load clinical data
-            path_to_clin_table = Path(save_paths[i], "synthetic_data_clinical.csv")
-            clinical = pd.read_csv(path_to_clin_table)
+        return
 
-            # Filter clinical table
-            clinical_sample = clinical[clinical[primary_key].isin(sample_ids)]
-
-            # Saving bootstrapped clinical data
-            clinical_sample.to_csv(
-                Path(save_paths[i], "synthetic_data_clinical_bootstrapped.csv"),
-                header=True,
-                index=False
+    for i in range(len(peptide_data_paths)):
+        if sample_from_saved_models:
+            # models fitted by an earlier run are sampled without loading the real data
+            data_sampling(
+                model_paths[i],
+                save_paths[i],
+                n_of_synth_samples[i],
+                batch_size,
+                processor,
+                random_seed,
+                streaming_sampling,
+                sampling_shard_size,
+                sampling_workers,
             )
-
-            # save statistic
-            print("#### Saving statistic ####")
-            stat = [
-                {'Peptide_id': peptide_id,
-                 'kl_divergence': values['kl_divergence'],
-                 'ks_p-value': values['ks_p-value']}
-                for peptide_id, values in statistic.items()
-            ]
-            # Convert the list of dictionaries into a pandas DataFrame
-            df = pd.DataFrame(stat)
-
-            # Save the DataFrame to a CSV file
-            df.to_csv(
-                Path(save_paths[i], "synthetic_data_peptides_statistic.csv"),
-                header=True,
-                index=False
+        else:
+            data_synthesis(
+                peptide_data_path=peptide_data_paths[i],
+                clinical_data_path=clinical_data_paths[i],
+                save_path=save_paths[i],
+                number_of_synth_samples=n_of_synth_samples[i],
+                streaming_sampling=streaming_sampling,
+                model_path=model_paths[i] if model_paths else None,
+                **synthesis_options,
             )
+        if bootstrapping:
+            bootstrap_synthetic_data(save_paths[i], **bootstrapping_options[i])
+
 
 
 
@@ -0,0 +1,354 @@
+import asyncio
+import io
+import json
+import multiprocessing
+import secrets
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import polars as pl
+import yaml
+from data_sampling import group_paths
+from src.data.data_models import Data, PostprocessingStatistics, Processor, SparsePeptides
+from src.data.data_processing import HFProcessorForSynthetization
+from src.modeling.synthetization import Synthesizer
+
+# end of stream marker of the Arrow IPC streaming format
+_ARROW_END_OF_STREAM = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+_CONTENT_TYPES = {"csv": "text/csv", "arrow": "application/vnd.apache.arrow.stream"}
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    503: "Service Unavailable",
+}
+
+# fitted groups and the processor loaded once in every worker process, keyed by (dataset, group)
+_SERVICE_MODELS = None
+_SERVICE_PROCESSOR = None
+
+
+def _load_service_models(model_paths: list[str], processor: Processor) -> None:
+    """load the fitted synthesizers and postprocessing statistics of all groups in a worker process"""
+    global _SERVICE_MODELS, _SERVICE_PROCESSOR
+    _SERVICE_PROCESSOR = processor
+    _SERVICE_MODELS = {}
+    for dataset, model_path in enumerate(model_paths):
+        for group, group_path in enumerate(group_paths(model_path)):
+            postprocessing = PostprocessingStatistics.load(group_path / "postprocessing.json")
+            _SERVICE_MODELS[dataset, group] = (
+                Synthesizer.load(group_path),
+                postprocessing,
+                postprocessing.to_data(),
+            )
+
+
+def _sample_rows(
+        dataset: int,
+        group: int,
+        num_rows: int,
+        seed_sequence: np.random.SeedSequence,
+        first_id: int,
+) -> pl.DataFrame:
+    """
+    sample and postprocess a batch with the models of the worker process
+    Args:
+        dataset: index of the model path of the group
+        group: index of the group within its model path
+        num_rows: number of rows in the batch
+        seed_sequence: seed of the batch, its rows do not depend on batches sampled before
+        first_id: primary key of the first row of the batch
+
+    Returns: dataframe with the clinical and peptide columns of the batch
+    """
+    synthesizer, postprocessing, data = _SERVICE_MODELS[dataset, group]
+    model_seed, imputation_seed = seed_sequence.spawn(2)
+    synthesizer.sdv_synthesizer.set_random_state(model_seed)
+    # postprocess_data would report every batch on stdout
+    synthetic_data = _SERVICE_PROCESSOR._postprocess_batch(
+        data,
+        postprocessing.remaining_peptides,
+        synthesizer.sample(num_rows),
+        np.random.default_rng(imputation_seed),
+        postprocessing.statistics,
+    )
+    return _merge_batch(synthetic_data, postprocessing.primary_key, first_id)
+
+
+def _merge_batch(data: Data, primary_key: str, first_id: int) -> pl.DataFrame:
+    """join the clinical and peptide tables of a batch, primary keys are numbered from `first_id`"""
+    ids = pl.arange(first_id, first_id + data.clinical.height, eager=True).alias(primary_key)
+    if isinstance(data.peptides, SparsePeptides):
+        data.peptides.ids = ids
+        peptides = data.peptides.to_frame()
+    else:
+        peptides = data.peptides.fill_null(0.0)
+    return pl.concat(
+        [data.clinical.with_columns(ids), peptides.drop(primary_key)], how="horizontal"
+    )
+
+
+class _BatchEncoder:
+    def __init__(self, output_format: str):
+        """
+        encoder of the batches of a response into a single csv table or Arrow stream
+        The csv header or the Arrow schema is written with the first batch, later batches are cast to the
+        Arrow schema of the first one.
+        Args:
+            output_format: "csv" or "arrow"
+        """
+        self.output_format = output_format
+        self.schema = None
+        self._first = True
+
+    def encode(self, batch: pl.DataFrame) -> bytes:
+        first, self._first = self._first, False
+        if self.output_format == "csv":
+            buffer = io.BytesIO()
+            batch.write_csv(buffer, include_header=first)
+            return buffer.getvalue()
+
+        table = batch.to_arrow()
+        chunk = b""
+        if first:
+            self.schema = table.schema
+            chunk = self.schema.serialize().to_pybytes()
+        for record_batch in table.cast(self.schema).to_batches():
+            chunk += record_batch.serialize().to_pybytes()
+        return chunk
+
+    def end(self) -> bytes:
+        return _ARROW_END_OF_STREAM if self.output_format == "arrow" else b""
+
+
+class SamplingService:
+    def __init__(
+            self,
+            model_paths: list[str],
+            processor: Processor,
+            batch_size: int = 100,
+            n_workers: int = 1,
+            max_requests: int = 8,
+            max_pending_batches: int = 2,
+            max_rows: int = 1_000_000,
+    ):
+        """
+        local HTTP service sampling synthetic patients from synthesizers saved by `data_synthesis`
+        Every worker process loads the fitted groups once, arrays of the NumPy engines are memory mapped
+        and shared between the workers. A request is split into batches of `batch_size` rows which are
+        sampled by the workers and streamed back in order. Every batch draws from its own stream spawned
+        from the seed of the request, so a request with a seed always returns the same rows.
+
+        Backpressure: a request has at most `max_pending_batches` batches in flight, the next batch is only
+        submitted once the oldest one is sent to a client which reads it. Requests beyond `max_requests`
+        are rejected with 503 instead of queueing without bound.
+
+        Endpoints:
+            GET /groups: JSON list of the groups which can be sampled
+            GET /sample?group=0&count=100&seed=42&format=csv: rows of a group as csv or Arrow stream
+                (format=arrow), `dataset` selects the model path if there is more than one.
+                The seed used is returned in the `X-Seed` header.
+        Args:
+            model_paths: directories with one saved synthesizer per group of patients
+            processor: processor postprocessing the synthetic data
+            batch_size: number of rows sampled by a worker at once
+            n_workers: number of worker processes sampling batches
+            max_requests: maximum number of sampling requests served at once
+            max_pending_batches: maximum number of batches of a request sampled ahead of the client
+            max_rows: maximum number of rows of a request
+        """
+        self.model_paths = model_paths
+        self.processor = processor
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self.max_requests = max_requests
+        self.max_pending_batches = max_pending_batches
+        self.max_rows = max_rows
+
+        self.groups = {}
+        for dataset, model_path in enumerate(model_paths):
+            paths = group_paths(model_path)
+            if not paths:
+                raise FileNotFoundError(f"No saved synthesizers found in '{model_path}'.")
+            for group, group_path in enumerate(paths):
+                self.groups[dataset, group] = PostprocessingStatistics.load(group_path / "postprocessing.json")
+
+        self._executor = None
+        self._active_requests = 0
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """
+        load the models in the worker processes and serve requests until cancelled
+        Args:
+            host: interface to listen on
+            port: port to listen on
+        """
+        # spawned workers do not inherit the sockets of open connections, which would keep them open after an abort
+        with ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_load_service_models,
+                initargs=(self.model_paths, self.processor),
+        ) as executor:
+            self._executor = executor
+            server = await asyncio.start_server(self._handle, host, port)
+            print(f"Serving {len(self.groups)} groups on http://{host}:{port}.")
+            async with server:
+                await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """serve a single request, the connection is closed afterwards"""
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # headers are not used
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3:
+                await self._respond(writer, 400, {"error": "Malformed request."})
+                return
+            method, target, _ = parts
+            url = urlsplit(target)
+            if method != "GET":
+                await self._respond(writer, 405, {"error": f"Method {method} is not allowed."})
+            elif url.path == "/groups":
+                await self._respond(writer, 200, self._describe_groups())
+            elif url.path == "/sample":
+                await self._sample(writer, {key: values[-1] for key, values in parse_qs(url.query).items()})
+            else:
+                await self._respond(writer, 404, {"error": f"Unknown path '{url.path}'."})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    def _describe_groups(self) -> list[dict]:
+        return [
+            {
+                "dataset": dataset,
+                "group": group,
+                "clinical_columns": postprocessing.clinical_columns,
+                "number_of_peptides": len(postprocessing.peptide_columns) - 1,
+            }
+            for (dataset, group), postprocessing in self.groups.items()
+        ]
+
+    async def _sample(self, writer: asyncio.StreamWriter, query: dict[str, str]) -> None:
+        """stream the rows of a sampling request in batches"""
+        try:
+            dataset = int(query.get("dataset", 0))
+            group = int(query["group"])
+            count = int(query["count"])
+            seed = int(query["seed"]) if "seed" in query else secrets.randbits(64)
+            seed_sequence = np.random.SeedSequence(seed)
+        except (KeyError, ValueError):
+            await self._respond(
+                writer, 400, {"error": "Integer 'group' and 'count' and a non-negative 'seed' are required."}
+            )
+            return
+        output_format = query.get("format", "csv")
+        if output_format not in _CONTENT_TYPES:
+            await self._respond(writer, 400, {"error": f"Unknown format '{output_format}'."})
+            return
+        if not 0 < count <= self.max_rows:
+            await self._respond(writer, 400, {"error": f"'count' must be between 1 and {self.max_rows}."})
+            return
+        if (dataset, group) not in self.groups:
+            await self._respond(writer, 404, {"error": f"Unknown group {group} of dataset {dataset}."})
+            return
+        if self._active_requests >= self.max_requests:
+            await self._respond(writer, 503, {"error": "Too many requests."}, {"Retry-After": "1"})
+            return
+
+        self._active_requests += 1
+        loop = asyncio.get_running_loop()
+        pending = deque()
+        try:
+            await self._start_response(writer, 200, _CONTENT_TYPES[output_format], {"X-Seed": str(seed)})
+            encoder = _BatchEncoder(output_format)
+            for start in range(0, count, self.batch_size):
+                pending.append(loop.run_in_executor(
+                    self._executor,
+                    _sample_rows,
+                    dataset,
+                    group,
+                    min(self.batch_size, count - start),
+                    seed_sequence.spawn(1)[0],
+                    start + 1,
+                ))
+                if len(pending) >= self.max_pending_batches:
+                    await self._send_chunk(writer, encoder.encode(await pending.popleft()))
+            while pending:
+                await self._send_chunk(writer, encoder.encode(await pending.popleft()))
+            if end := encoder.end():
+                await self._send_chunk(writer, end)
+            await self._send_chunk(writer, b"")
+        except ConnectionError:
+            raise
+        except Exception as error:
+            print(f"Sampling {count} rows of group {group} of dataset {dataset} failed: {error!r}")
+            # the status is already sent, an aborted connection without the last chunk marks the body incomplete
+            writer.transport.abort()
+        finally:
+            for future in pending:
+                future.cancel()
+            self._active_requests -= 1
+
+    @staticmethod
+    async def _send_chunk(writer: asyncio.StreamWriter, chunk: bytes) -> None:
+        """send a chunk of the chunked transfer encoding and wait until the client reads it"""
+        writer.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _start_response(
+            writer: asyncio.StreamWriter,
+            status: int,
+            content_type: str,
+            headers: dict[str, str] | None = None,
+    ) -> None:
+        lines = [
+            f"HTTP/1.1 {status} {_REASONS[status]}",
+            f"Content-Type: {content_type}",
+            "Transfer-Encoding: chunked",
+            "Connection: close",
+        ]
+        lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _respond(
+            self,
+            writer: asyncio.StreamWriter,
+            status: int,
+            body: dict | list,
+            headers: dict[str, str] | None = None,
+    ) -> None:
+        """send a complete JSON response"""
+        await self._start_response(writer, status, "application/json", headers)
+        await self._send_chunk(writer, json.dumps(body).encode())
+        await self._send_chunk(writer, b"")
+
+
+def main(config_file="configuration.yaml"):
+    with open(config_file, "r") as file:
+        config = yaml.safe_load(file)
+    synthesis = config.get("synthesis", {})
+    service = config.get("sampling_service", {})
+
+    sampling_service = SamplingService(
+        synthesis.get("model_paths"),
+        HFProcessorForSynthetization(primary_key=synthesis.get("primary_key")),
+        synthesis.get("batch_size", 100),
+        service.get("workers", 1),
+        service.get("max_requests", 8),
+        service.get("max_pending_batches", 2),
+        service.get("max_rows", 1_000_000),
+    )
+    asyncio.run(sampling_service.serve(service.get("host", "127.0.0.1"), service.get("port", 8080)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import shutil
+from pathlib import Path
+
+import polars as pl
+
+from src.data.data_models import Data, Processor
+
+# bump whenever the layout of cached tables changes so stale entries are not reused
+CACHE_FORMAT_VERSION = 1
+
+
+class PreprocessedDataCache:
+    def __init__(self, cache_dir: str | Path, chunk_size: int = 1 << 20):
+        """
+        on-disk cache of preprocessed clinical and peptide tables stored in the Arrow IPC format
+        Entries are content addressed: the key is a hash of the raw input files and of the
+        processor settings, so editing a CSV or changing the processor invalidates the entry.
+        Cached tables are memory-mapped on load instead of being parsed again.
+        Args:
+            cache_dir: directory where cached tables are stored
+            chunk_size: number of bytes read at once while hashing input files
+        """
+        self.cache_dir = Path(cache_dir)
+        self.chunk_size = chunk_size
+
+    def get_key(self, data_paths: list[str], processor: Processor | None) -> str:
+        """
+        compute the cache key for the given input files and processor
+        Args:
+            data_paths: paths to the raw input files
+            processor: processor used to preprocess the raw data
+        Returns: hex digest identifying the preprocessed data
+        """
+        digest = hashlib.sha256()
+        digest.update(f"format={CACHE_FORMAT_VERSION}".encode())
+
+        for data_path in data_paths:
+            with open(data_path, "rb") as file:
+                while chunk := file.read(self.chunk_size):
+                    digest.update(chunk)
+            # separator so that moving bytes between files changes the key
+            digest.update(b"\x00")
+
+        if processor is not None:
+            settings = {
+                "processor": f"{type(processor).__module__}.{type(processor).__qualname__}",
+                **vars(processor),
+            }
+            digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+
+        return digest.hexdigest()
+
+    def load(self, key: str, lazy_peptides: bool = False) -> Data | None:
+        """
+        load cached data
+        Args:
+            key: cache key returned by `get_key`
+            lazy_peptides: if True, peptides are returned as a lazy frame scanning the cached table
+        Returns: cached data or None if there is no entry for the key
+        """
+        entry = self.cache_dir / key
+        clinical_path = entry / "clinical.arrow"
+        peptides_path = entry / "peptides.arrow"
+        if not (clinical_path.exists() and peptides_path.exists()):
+            return None
+
+        if lazy_peptides:
+            peptides = pl.scan_ipc(peptides_path, memory_map=True)
+        else:
+            peptides = pl.read_ipc(peptides_path, memory_map=True)
+
+        return Data(
+            clinical=pl.read_ipc(clinical_path, memory_map=True),
+            peptides=peptides,
+        )
+
+    def save(self, key: str, data: Data) -> None:
+        """
+        store data in the cache
+        The entry is written to a temporary directory first and then renamed, so concurrent
+        readers never see a partially written entry. Lazy peptides are streamed into the cache.
+        Args:
+            key: cache key returned by `get_key`
+            data: preprocessed data
+        """
+        entry = self.cache_dir / key
+        if entry.exists():
+            return
+
+        tmp_entry = self.cache_dir / f"{key}.tmp"
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tmp_entry.mkdir(parents=True)
+
+        # uncompressed IPC files can be memory-mapped when loaded
+        data.clinical.write_ipc(tmp_entry / "clinical.arrow", compression="uncompressed")
+        if isinstance(data.peptides, pl.LazyFrame):
+            data.peptides.sink_ipc(tmp_entry / "peptides.arrow", compression=None)
+        else:
+            data.peptides.write_ipc(tmp_entry / "peptides.arrow", compression="uncompressed")
+
+        try:
+            tmp_entry.rename(entry)
+        except OSError:
+            # another process stored the same entry in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
@@ -1,6 +1,9 @@
+from pathlib import Path
+
 import polars as pl
 
-from src.data.data_models import Data, Processor
+from src.data.data_cache import PreprocessedDataCache
+from src.data.data_models import Data, Processor, SparsePeptides
 
 
 class DataLoader:
@@ -11,7 +14,10 @@ class DataLoader:
             primary_key: str,
             number_of_samples: int | None = None,
             processor: Processor | None = None,
-            filter_conditions: dict | None = None
+            filter_conditions: dict | None = None,
+            cache_dir: str | Path | None = None,
+            streaming: bool = False,
+            sparse: bool = False,
     ):
         """
         dataloader class used to parse clinical and peptide data
@@ -22,6 +28,9 @@ class DataLoader:
             number_of_samples: number of samples to use, if None all data is used
             processor: Processor object to use for data processing
             filter_conditions: conditions to use for filtering data
+            cache_dir: directory for caching preprocessed data, if None nothing is cached
+            streaming: if True, peptides are kept as a lazy frame and never loaded as a whole
+            sparse: if True, peptides are stored in a sparse matrix after preprocessing
         """
         self.clinical_data_path = clinical_data_path
         self.peptides_data_path = peptides_data_path
@@ -29,20 +38,14 @@ class DataLoader:
         self.primary_key = primary_key
         self.number_of_samples = number_of_samples
         self.filter_conditions = filter_conditions
+        self.cache = PreprocessedDataCache(cache_dir) if cache_dir is not None else None
+        self.streaming = streaming
+        self.sparse = sparse
 
     def get_data(self) -> Data:
         """If processor is provided, it will preprocess loaded data. Otherwise, raw data is loaded."""
         try:
-            clinical = pl.read_csv(self.clinical_data_path)
-            peptides = pl.read_csv(self.peptides_data_path)
-            data = Data(clinical=clinical, peptides=peptides)
-
-            if self.processor:
-                data = self.processor.preprocess_data(data)
-
-            if self.number_of_samples:
-                data.clinical = data.clinical.sort(self.primary_key).slice(0, self.number_of_samples)
-                data.peptides = data.peptides.sort(self.primary_key).slice(0, self.number_of_samples)
+            data = self._load_data()
 
             if self.filter_conditions:
                 data.clinical = self._apply_filter_conditions(data.clinical)
@@ -53,6 +56,85 @@ class DataLoader:
             print(e, "\n")
             raise ValueError("Data is not loaded correctly!")
 
+    def get_grouped_data(self, filters: list[dict]) -> list[Data]:
+        """
+        parse and preprocess the dataset a single time and derive every filter group from it
+        Each group is computed as a predicate pushed down into a lazy query over the shared
+        clinical table, and all groups share the same (unfiltered) peptide table, exactly as
+        if `get_data` had been called once per filter.
+        Args:
+            filters: list of filter conditions, one per group of patients
+        Returns: list of Data objects in the same order as `filters`
+        """
+        try:
+            data = self._load_data()
+
+            shared_clinical = data.clinical.lazy()
+            group_queries = [
+                shared_clinical.filter(self._filter_expression(filter_dict, data.clinical.columns))
+                for filter_dict in filters
+            ]
+            grouped_clinical = pl.collect_all(group_queries)
+
+            for filter_dict, clinical in zip(filters, grouped_clinical):
+                if clinical.is_empty():
+                    raise ValueError(
+                        f"The filtering operation {filter_dict} resulted in an empty DataFrame."
+                    )
+
+            return [Data(clinical=clinical, peptides=data.peptides) for clinical in grouped_clinical]
+
+        except Exception as e:
+            print(e, "\n")
+            raise ValueError("Data is not loaded correctly!")
+
+    def _load_data(self) -> Data:
+        """
+        parse both tables (in parallel), preprocess them and limit the number of samples
+        If a cache directory is set, preprocessed tables are read from the cache when the input
+        files and processor are unchanged, and stored in it otherwise.
+        In streaming mode peptides are returned as a lazy frame. When a cache is used, the preprocessed
+        peptides are streamed into it and scanned from there, so later passes can project single columns.
+        In sparse mode the preprocessed peptides are converted to a sparse matrix.
+        Returns: loaded data
+        """
+        data = None
+        if self.cache is not None:
+            cache_key = self.cache.get_key(
+                [self.clinical_data_path, self.peptides_data_path], self.processor
+            )
+            data = self.cache.load(cache_key, lazy_peptides=self.streaming)
+            if data is not None:
+                print(f"Loaded preprocessed data from cache ({cache_key[:12]}).")
+
+        if data is None:
+            if self.streaming:
+                clinical = pl.read_csv(self.clinical_data_path)
+                peptides = pl.scan_csv(self.peptides_data_path)
+            else:
+                clinical, peptides = pl.collect_all(
+                    [pl.scan_csv(self.clinical_data_path), pl.scan_csv(self.peptides_data_path)]
+                )
+            data = Data(clinical=clinical, peptides=peptides)
+
+            if self.processor:
+                data = self.processor.preprocess_data(data)
+
+            if self.cache is not None:
+                self.cache.save(cache_key, data)
+                if self.streaming:
+                    data = self.cache.load(cache_key, lazy_peptides=True)
+
+        if self.number_of_samples:
+            data.clinical = data.clinical.sort(self.primary_key).slice(0, self.number_of_samples)
+            data.peptides = data.peptides.sort(self.primary_key).slice(0, self.number_of_samples)
+
+        if self.sparse:
+            # combined with streaming, the lazy peptides are converted in column chunks
+            data.peptides = SparsePeptides.from_frame(data.peptides, self.primary_key)
+
+        return data
+
     def _apply_filter_conditions(self, df: pl.DataFrame) -> pl.DataFrame:
         """
         Applies the specified filter conditions to the DataFrame.
@@ -63,11 +145,31 @@ class DataLoader:
         Returns:
         - pl.DataFrame: The filtered DataFrame.
         """
+        df = df.filter(self._filter_expression(self.filter_conditions, df.columns))
+
+        # Check if the resulting DataFrame is empty
+        if df.is_empty():
+            raise ValueError("The filtering operation resulted in an empty DataFrame.")
+
+        return df
+
+    def _filter_expression(self, filter_conditions: dict, columns: list[str]) -> pl.Expr:
+        """
+        Builds a single predicate expression from the filter conditions.
+
+        Parameters:
+        - filter_conditions (dict): Mapping of column name to a condition.
+        - columns (list[str]): Columns of the DataFrame the predicate will be applied to.
+
+        Returns:
+        - pl.Expr: Conjunction of all conditions.
+        """
         valid_operators = {"==", ">", "<", ">=", "<="}
 
-        for column, condition in self.filter_conditions.items():
+        predicate = pl.lit(True)
+        for column, condition in filter_conditions.items():
             # Check if the column exists in the DataFrame
-            if column not in df.columns:
+            if column not in columns:
                 raise ValueError(f"Column '{column}' does not exist in the DataFrame.")
 
             if isinstance(condition, tuple):
@@ -79,31 +181,27 @@ class DataLoader:
                 if operator not in valid_operators:
                     raise ValueError(
                         f"Invalid operator '{operator}' for column '{column}'. Expected one of {valid_operators}.")
-                df = self._apply_operator(df, column, operator, value)
+                predicate = predicate & self._operator_expression(column, operator, value)
             else:
                 # Default equality condition
-                df = df.filter(pl.col(column) == condition)
-
-        # Check if the resulting DataFrame is empty
-        if df.is_empty():
-            raise ValueError("The filtering operation resulted in an empty DataFrame.")
+                predicate = predicate & (pl.col(column) == condition)
 
-        return df
+        return predicate
 
     @staticmethod
-    def _apply_operator(df: pl.DataFrame, column: str, operator: str, value) -> pl.DataFrame:
+    def _operator_expression(column: str, operator: str, value) -> pl.Expr:
         """
-        Helper method to apply an operator-based condition to a DataFrame column.
+        Helper method to build an operator-based condition on a DataFrame column.
         """
         if operator == "==":
-            return df.filter(pl.col(column) == value)
+            return pl.col(column) == value
         elif operator == ">":
-            return df.filter(pl.col(column) > value)
+            return pl.col(column) > value
         elif operator == "<":
-            return df.filter(pl.col(column) < value)
+            return pl.col(column) < value
         elif operator == ">=":
-            return df.filter(pl.col(column) >= value)
+            return pl.col(column) >= value
         elif operator == "<=":
-            return df.filter(pl.col(column) <= value)
+            return pl.col(column) <= value
         else:
             raise ValueError(f"Unsupported operator '{operator}' for column '{column}'.")
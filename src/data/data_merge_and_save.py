@@ -1,22 +1,24 @@
 from pathlib import Path
 import polars as pl
 import os
-import random
+
+from src.data.data_models import Data, SparsePeptides
 
 
 def merge_and_save(
     clinical_data_list: list[pl.DataFrame],
-    peptides_data_list: list[pl.DataFrame],
+    peptides_data_list: list[pl.DataFrame] | list[SparsePeptides],
     primary_key: str,
     save_to: Path | None = None,
 ) -> None:
     """
     function which merges multiple groups of synthetic patients into single tables for clinical
     and peptide data
+    Primary keys are numbered consecutively from 1 over all groups, so they are unique and reproducible.
     note: If `save_to` parameter is None, data will be saved to current working directory.
     Args:
         clinical_data_list: list of clinical synthetic dataframes
-        peptides_data_list: list of peptide synthetic dataframes
+        peptides_data_list: list of peptide synthetic dataframes or sparse peptide data
         save_to: path to directory where data will be saved
     """
 
@@ -25,22 +27,80 @@ def merge_and_save(
 
     clinical_data_merged = pl.concat(clinical_data_list)
     n = clinical_data_merged.shape[0]
-    random_number = random.randint(0, 10000)
-    clinical_data_merged = clinical_data_merged.with_columns(
-        (pl.arange(1, n + 1) + pl.lit(random_number)).alias(primary_key)
-    )
-    peptides_data_merged = pl.concat(peptides_data_list).fill_null(0.0)
-    peptides_data_merged = peptides_data_merged.with_columns(
-        (pl.arange(1, n + 1) + pl.lit(random_number)).alias(primary_key)
-    )
+    new_ids = pl.arange(1, n + 1, eager=True)
+    clinical_data_merged = clinical_data_merged.with_columns(new_ids.alias(primary_key))
+
+    if isinstance(peptides_data_list[0], SparsePeptides):
+        peptides_data_merged = SparsePeptides.concat(peptides_data_list)
+        peptides_data_merged.ids = new_ids.alias(primary_key)
+    else:
+        peptides_data_merged = pl.concat(peptides_data_list).fill_null(0.0)
+        peptides_data_merged = peptides_data_merged.with_columns(new_ids.alias(primary_key))
 
     Path.mkdir(save_to, exist_ok=True) if save_to is not None else os.getcwd()
 
     clinical_data_merged.write_csv(
         Path(save_to, "synthetic_data_clinical.csv"), include_header=True
     )
-    peptides_data_merged.write_csv(
-        Path(save_to, "synthetic_data_peptides.csv"), include_header=True
-    )
+    if isinstance(peptides_data_merged, SparsePeptides):
+        # sparse peptides are densified in row chunks while writing
+        peptides_data_merged.write_csv(Path(save_to, "synthetic_data_peptides.csv"))
+    else:
+        peptides_data_merged.write_csv(
+            Path(save_to, "synthetic_data_peptides.csv"), include_header=True
+        )
 
     print(f"Data saved to: {save_to}.")
+
+
+class SyntheticDataWriter:
+    def __init__(self, primary_key: str, save_to: Path | None = None):
+        """
+        writer which appends batches of synthetic patients to the clinical and peptide tables
+        Batches are written as soon as they are produced, so memory is bounded by the batch size instead of
+        the number of synthetic patients. The output files are created with the first batch. Primary keys
+        are assigned consecutively over all batches, the same way as in `merge_and_save`.
+        note: If `save_to` parameter is None, data will be saved to current working directory.
+        Args:
+            primary_key: primary key column name
+            save_to: path to directory where data will be saved
+        """
+        self.primary_key = primary_key
+        self.save_to = Path(save_to) if save_to is not None else Path(os.getcwd())
+        self.number_of_rows = 0
+        self._clinical_file = None
+        self._peptides_file = None
+
+    def write(self, data: Data) -> None:
+        """
+        append a batch of synthetic patients
+        Args:
+            data: postprocessed batch with clinical and dense or sparse peptide tables
+        """
+        include_header = self._clinical_file is None
+        if include_header:
+            self.save_to.mkdir(exist_ok=True)
+            self._clinical_file = open(Path(self.save_to, "synthetic_data_clinical.csv"), "w")
+            self._peptides_file = open(Path(self.save_to, "synthetic_data_peptides.csv"), "w")
+
+        n = data.clinical.height
+        new_ids = pl.arange(1, n + 1, eager=True) + self.number_of_rows
+        self.number_of_rows += n
+
+        data.clinical.with_columns(new_ids.alias(self.primary_key)).write_csv(
+            self._clinical_file, include_header=include_header
+        )
+        if isinstance(data.peptides, SparsePeptides):
+            data.peptides.ids = new_ids.alias(self.primary_key)
+            data.peptides.write_csv(self._peptides_file, include_header=include_header)
+        else:
+            data.peptides.fill_null(0.0).with_columns(new_ids.alias(self.primary_key)).write_csv(
+                self._peptides_file, include_header=include_header
+            )
+
+    def close(self) -> None:
+        """close the output files"""
+        if self._clinical_file is not None:
+            self._clinical_file.close()
+            self._peptides_file.close()
+        print(f"Data saved to: {self.save_to}.")
@@ -1,23 +1,278 @@
 from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import IO, Iterable, Iterator
 
 import numpy as np
 import pandas as pd
 import polars as pl
 from pydantic import BaseModel
-from tqdm import tqdm
+from scipy import sparse
+
+
+class SparsePeptides(BaseModel):
+    """
+    peptide data stored column-wise in a scipy sparse matrix, zero values are not stored
+    """
+    primary_key: str
+    ids: pl.Series
+    columns: list[str]
+    values: sparse.csc_array
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @classmethod
+    def from_frame(
+            cls,
+            peptides: pl.DataFrame | pl.LazyFrame,
+            primary_key: str,
+            column_chunk_size: int = 1000,
+    ) -> "SparsePeptides":
+        """
+        build sparse peptide data from a polars frame
+        Columns are densified in chunks of `column_chunk_size` columns, so a lazy frame is never
+        loaded as a whole.
+        Args:
+            peptides: peptide data containing the primary key column
+            primary_key: column name of the primary key column
+            column_chunk_size: number of columns converted at once
+
+        Returns: sparse peptide data
+        """
+        columns = [col for col in peptides.collect_schema().names() if col != primary_key]
+        ids = peptides.lazy().select(primary_key).collect().to_series()
+
+        blocks = [sparse.csc_array((len(ids), 0))]
+        for start in range(0, len(columns), column_chunk_size):
+            chunk = columns[start:start + column_chunk_size]
+            dense_chunk = peptides.lazy().select(pl.col(chunk).cast(pl.Float64)).collect().to_numpy()
+            blocks.append(sparse.csc_array(dense_chunk))
+
+        return cls(
+            primary_key=primary_key,
+            ids=ids,
+            columns=columns,
+            values=sparse.hstack(blocks, format="csc"),
+        )
+
+    @classmethod
+    def concat(cls, items: list["SparsePeptides"]) -> "SparsePeptides":
+        """
+        stack sparse peptide data with the same columns on top of each other
+        Args:
+            items: sparse peptide data to concatenate
+
+        Returns: concatenated sparse peptide data
+        """
+        for item in items[1:]:
+            if item.columns != items[0].columns:
+                raise ValueError("All sparse peptide tables must have the same columns.")
+
+        return cls(
+            primary_key=items[0].primary_key,
+            ids=pl.concat([item.ids for item in items]),
+            columns=items[0].columns,
+            values=sparse.vstack([item.values for item in items], format="csc"),
+        )
+
+    @property
+    def height(self) -> int:
+        return self.values.shape[0]
+
+    def collect_schema(self) -> pl.Schema:
+        """schema of the equivalent dense peptide table, primary key first"""
+        return pl.Schema({self.primary_key: self.ids.dtype, **{col: pl.Float64 for col in self.columns}})
+
+    def select(self, columns: list[str]) -> "SparsePeptides":
+        """
+        select a subset of peptide columns
+        Args:
+            columns: peptide columns to keep, the primary key is always kept
+
+        Returns: sparse peptide data with the selected columns
+        """
+        column_index = {col: i for i, col in enumerate(self.columns)}
+        columns = [col for col in columns if col != self.primary_key]
+        return SparsePeptides(
+            primary_key=self.primary_key,
+            ids=self.ids,
+            columns=columns,
+            values=self.values[:, [column_index[col] for col in columns]],
+        )
+
+    def column_values(self, column: str) -> np.ndarray:
+        """
+        non-zero and non-null values of a single column, read directly from the sparse structure
+        Args:
+            column: peptide column name
+
+        Returns: array of the non-zero values
+        """
+        i = self.columns.index(column)
+        values = self.values.data[self.values.indptr[i]:self.values.indptr[i + 1]]
+        # explicitly stored zeros are possible after arithmetic on the matrix, nulls are stored as NaN
+        return values[(values != 0) & ~np.isnan(values)]
+
+    def column_statistics(self, columns: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        count zero and null values and compute the mean of each column without densifying
+        nulls are stored as NaN, the primary key column is supported as well
+        Args:
+            columns: columns to aggregate
+
+        Returns: zero counts, null counts and means of the columns
+        """
+        column_index = {col: i for i, col in enumerate(self.columns)}
+        zero_counts, null_counts, means = [], [], []
+        for col in columns:
+            if col == self.primary_key:
+                values = self.ids.cast(pl.Float64).to_numpy()
+                zero_counts.append(int((values == 0).sum()))
+                null_counts.append(self.ids.null_count())
+                means.append(self.ids.mean())
+                continue
+
+            i = column_index[col]
+            values = self.values.data[self.values.indptr[i]:self.values.indptr[i + 1]]
+            nulls = int(np.isnan(values).sum())
+            zero_counts.append(self.height - len(values) + int((values == 0).sum()))
+            null_counts.append(nulls)
+            means.append(np.nansum(values) / (self.height - nulls) if self.height > nulls else np.nan)
+
+        return (
+            np.array(zero_counts, dtype=np.int64),
+            np.array(null_counts, dtype=np.int64),
+            np.array(means, dtype=np.float64),
+        )
+
+    def to_frame(self, columns: list[str] | None = None) -> pl.DataFrame:
+        """
+        densify (a subset of) the peptide columns
+        Args:
+            columns: peptide columns to densify, all columns if None
+
+        Returns: dense peptide dataframe with the primary key as the first column
+        """
+        subset = self if columns is None else self.select(columns)
+        dense = pl.DataFrame(subset.values.toarray(), schema=subset.columns).fill_nan(None)
+        return dense.insert_column(0, self.ids.alias(self.primary_key))
+
+    def write_csv(self, file: str | IO, row_chunk_size: int = 10_000, include_header: bool = True) -> None:
+        """
+        write the peptide table as csv, only `row_chunk_size` rows are densified at once
+        Args:
+            file: path or file object to write to
+            row_chunk_size: number of rows densified and written at once
+            include_header: if False, only the rows are written, e.g. when appending to an existing file
+        """
+        rows = self.values.tocsr()
+        close = isinstance(file, str) or hasattr(file, "__fspath__")
+        handle = open(file, "w") if close else file
+        try:
+            for start in range(0, max(self.height, 1), row_chunk_size):
+                chunk = rows[start:start + row_chunk_size]
+                dense = pl.DataFrame(chunk.toarray(), schema=self.columns).fill_nan(None)
+                dense = dense.insert_column(
+                    0, self.ids.slice(start, row_chunk_size).alias(self.primary_key)
+                )
+                dense.write_csv(handle, include_header=include_header and start == 0)
+        finally:
+            if close:
+                handle.close()
 
 
 class Data(BaseModel):
     """
     data structure containing both clinical and peptide data in polars dataframes
+    peptides can also be a lazy frame, in which case wide peptide tables are only read in column chunks,
+    or sparse peptide data, in which case zero values are never stored
     """
     clinical: pl.DataFrame
-    peptides: pl.DataFrame
+    peptides: pl.DataFrame | pl.LazyFrame | SparsePeptides
 
     class Config:
         arbitrary_types_allowed = True
 
 
+class PostprocessingStatistics(BaseModel):
+    """
+    everything `postprocess_data` needs from the real data of a group of patients
+    Stored next to a fitted synthesizer, so synthetic data can be postprocessed without loading the real data.
+    """
+    primary_key: str
+    clinical_columns: list[str]
+    peptide_columns: list[str]
+    remaining_peptides: list[str]
+    zero_counts: list[int]
+    null_counts: list[int]
+    means: list[float | None]
+    number_of_rows: int
+    sparse: bool = False
+
+    @classmethod
+    def from_data(cls, data: Data, remaining_peptides: list[str], primary_key: str) -> "PostprocessingStatistics":
+        """
+        collect the column names of a group and the statistics of the peptides which are imputed
+        Args:
+            data: original data of real patients
+            remaining_peptides: peptides which were not modeled using copulas due to not enough examples
+            primary_key: column name of the primary key column
+
+        Returns: postprocessing statistics
+        """
+        zero_counts, null_counts, means, number_of_rows = Processor._column_statistics(
+            data.peptides, remaining_peptides
+        )
+        return cls(
+            primary_key=primary_key,
+            clinical_columns=data.clinical.columns,
+            peptide_columns=data.peptides.collect_schema().names(),
+            remaining_peptides=remaining_peptides,
+            zero_counts=zero_counts.tolist(),
+            null_counts=null_counts.tolist(),
+            means=[None if np.isnan(mean) else mean for mean in means.tolist()],
+            number_of_rows=number_of_rows,
+            sparse=isinstance(data.peptides, SparsePeptides),
+        )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "PostprocessingStatistics":
+        with open(path) as file:
+            return cls.model_validate_json(file.read())
+
+    def save(self, path: str | Path) -> None:
+        with open(path, "w") as file:
+            file.write(self.model_dump_json())
+
+    @property
+    def statistics(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """statistics of the remaining peptides in the format of `Processor._column_statistics`"""
+        return (
+            np.array(self.zero_counts, dtype=np.int64),
+            np.array(self.null_counts, dtype=np.int64),
+            np.array(self.means, dtype=np.float64),
+            self.number_of_rows,
+        )
+
+    def to_data(self) -> Data:
+        """
+        empty data with the columns of the real data, which can be passed to `postprocess_data`
+        together with `statistics`
+        """
+        clinical = pl.DataFrame(schema=self.clinical_columns)
+        if self.sparse:
+            columns = [col for col in self.peptide_columns if col != self.primary_key]
+            peptides = SparsePeptides(
+                primary_key=self.primary_key,
+                ids=pl.Series(self.primary_key, [], dtype=pl.Int64),
+                columns=columns,
+                values=sparse.csc_array((0, len(columns))),
+            )
+        else:
+            peptides = pl.DataFrame(schema=self.peptide_columns)
+        return Data(clinical=clinical, peptides=peptides)
+
+
 class Processor(ABC):
     def __init__(
             self,
@@ -38,94 +293,277 @@ class Processor(ABC):
             self,
             data: Data,
             remaining_peptides: list[str],
-            synthetic_data: pl.DataFrame,
+            synthetic_data: pd.DataFrame | pl.DataFrame,
+            rng: np.random.Generator | None = None,
+            statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
     ) -> Data:
         """
         postprocess synthesized data into final dataset
+        Peptides which were not modeled are imputed with their mean value. For every such peptide
+        the share of non-zero values in the original data is kept, rows receiving the mean are
+        chosen at random with a single mask for all imputed peptides.
         Args:
             data: original data of real patients
             remaining_peptides: peptides which were not modeled using copulas due to not enough examples
             synthetic_data: result of the synthetic data generation using the copulas method
+            rng: random number generator used for the imputation mask, if None a fresh one is used
+            statistics: `_column_statistics` of the remaining peptides, computed if None
 
         Returns: synthetic dataset split into clinical and peptide tables
 
         """
-        remaining_columns = {}
+        postprocessed = self._postprocess_batch(data, remaining_peptides, synthetic_data, rng, statistics)
+        print(f"Data postprocessed.")
+        return postprocessed
+
+    def postprocess_batches(
+            self,
+            data: Data,
+            remaining_peptides: list[str],
+            synthetic_batches: Iterable[pd.DataFrame | pl.DataFrame],
+            rng: np.random.Generator | None = None,
+            statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
+    ) -> Iterator[Data]:
+        """
+        postprocess batches of synthesized data one at a time, see `postprocess_data`
+        Statistics of the imputed peptides are computed once, every batch keeps the original share of
+        non-zero values on its own.
+        Args:
+            data: original data of real patients
+            remaining_peptides: peptides which were not modeled using copulas due to not enough examples
+            synthetic_batches: batches of the synthetic data generation using the copulas method
+            rng: random number generator used for imputation, if None a fresh one is used
+            statistics: `_column_statistics` of the remaining peptides, computed if None
+
+        Returns: iterator over the postprocessed batches split into clinical and peptide tables
+        """
+        rng = np.random.default_rng(rng)
+        if statistics is None:
+            statistics = self._column_statistics(data.peptides, remaining_peptides)
+        for synthetic_data in synthetic_batches:
+            yield self._postprocess_batch(data, remaining_peptides, synthetic_data, rng, statistics)
 
-        original_peptides = data.peptides.to_pandas()
-        original_clinical = data.clinical.to_pandas()
+        print(f"Data postprocessed.")
 
-        for peptide in tqdm(remaining_peptides, desc="Postprocessing"):
-            if peptide not in original_peptides.columns:
+    def _postprocess_batch(
+            self,
+            data: Data,
+            remaining_peptides: list[str],
+            synthetic_data: pd.DataFrame | pl.DataFrame,
+            rng: np.random.Generator | None = None,
+            statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
+    ) -> Data:
+        """
+        impute the remaining peptides and split synthesized data into clinical and peptide tables
+        Args:
+            data: original data of real patients
+            remaining_peptides: peptides which were not modeled using copulas due to not enough examples
+            synthetic_data: result of the synthetic data generation using the copulas method
+            rng: random number generator used for imputation, if None a fresh one is used
+            statistics: `_column_statistics` of the remaining peptides, computed if None
+
+        Returns: synthetic dataset split into clinical and peptide tables
+        """
+        peptide_columns = data.peptides.collect_schema().names()
+        for peptide in remaining_peptides:
+            if peptide not in peptide_columns:
                 raise ValueError(
                     f"Peptide '{peptide}' not found in original data columns."
                 )
 
-            value = original_peptides[peptide].mean()
+        if isinstance(synthetic_data, pd.DataFrame):
+            synthetic_data = pl.from_pandas(synthetic_data)
 
-            missing_percentage = 1 - original_peptides[peptide].apply(
-                lambda x: bool(x)
-            ).sum() / len(original_peptides)
-            missing_count = int(missing_percentage * len(synthetic_data))
-            non_missing_count = len(synthetic_data) - missing_count
+        if isinstance(data.peptides, SparsePeptides):
+            return self._postprocess_sparse_data(data, remaining_peptides, synthetic_data, rng, statistics)
 
-            values = [value] * non_missing_count + [0.0] * missing_count
-            np.random.shuffle(values)
+        if remaining_peptides:
+            imputed_peptides = self._impute_peptides(
+                data.peptides, remaining_peptides, synthetic_data.height, rng, statistics
+            )
+            synthetic_data = pl.concat([synthetic_data, imputed_peptides], how="horizontal")
 
-            remaining_columns[peptide] = values
+        synthetic_data_clinical = synthetic_data.select(data.clinical.columns)
+        synthetic_data_peptides = synthetic_data.select(peptide_columns)
 
-        synthetic_data = pd.concat(
-            [synthetic_data, (pd.DataFrame(remaining_columns))], axis=1
+        return Data(
+            clinical=synthetic_data_clinical,
+            peptides=synthetic_data_peptides,
         )
 
-        synthetic_data_clinical = synthetic_data[original_clinical.columns]
-        synthetic_data_peptides = synthetic_data[
-            [
-                peptide if peptide != self.primary_key else peptide
-                for peptide in original_peptides.columns
-            ]
-        ]
+    def _postprocess_sparse_data(
+            self,
+            data: Data,
+            remaining_peptides: list[str],
+            synthetic_data: pl.DataFrame,
+            rng: np.random.Generator | None = None,
+            statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
+    ) -> Data:
+        """
+        postprocess synthesized data into a final dataset with sparse peptides
+        Only the modelled peptides are dense, the imputed peptides are built directly as sparse columns.
+        Args:
+            data: original data of real patients with sparse peptides
+            remaining_peptides: peptides which were not modeled using copulas due to not enough examples
+            synthetic_data: result of the synthetic data generation using the copulas method
+            rng: random number generator used for imputation, if None a fresh one is used
+            statistics: `_column_statistics` of the remaining peptides, computed if None
 
-        print(f"Data postprocessed.")
+        Returns: synthetic dataset split into clinical and sparse peptide tables
+        """
+        peptides: SparsePeptides = data.peptides
+        remaining = set(remaining_peptides)
+        modelled_peptides = [col for col in peptides.columns if col not in remaining]
+
+        modelled_values = sparse.csc_array(
+            synthetic_data.select(pl.col(modelled_peptides).cast(pl.Float64).fill_null(0.0)).to_numpy()
+        )
+        imputed_values = self._impute_sparse_peptides(
+            peptides, remaining_peptides, synthetic_data.height, rng, statistics
+        )
+
+        # restore the original column order
+        stacked_columns = modelled_peptides + remaining_peptides
+        position = {col: i for i, col in enumerate(stacked_columns)}
+        values = sparse.hstack([modelled_values, imputed_values], format="csc")
+        values = values[:, [position[col] for col in peptides.columns if col in position]]
 
         return Data(
-            clinical=pl.from_pandas(synthetic_data_clinical),
-            peptides=pl.from_pandas(synthetic_data_peptides),
+            clinical=synthetic_data.select(data.clinical.columns),
+            peptides=SparsePeptides(
+                primary_key=peptides.primary_key,
+                ids=synthetic_data[peptides.primary_key],
+                columns=[col for col in peptides.columns if col in position],
+                values=values,
+            ),
+        )
+
+    def _impute_sparse_peptides(
+            self,
+            peptides: SparsePeptides,
+            remaining_peptides: list[str],
+            number_of_samples: int,
+            rng: np.random.Generator | None = None,
+            statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
+    ) -> sparse.csc_array:
+        """
+        impute peptides which were not modeled as sparse columns
+        Same rule as `_impute_peptides`, but only the rows receiving the mean are drawn and stored,
+        so memory scales with the number of imputed non-zero values.
+        Args:
+            peptides: original sparse peptide data
+            remaining_peptides: peptides which should be imputed
+            number_of_samples: number of synthetic patients
+            rng: random number generator used for the imputation mask
+            statistics: `_column_statistics` of the remaining peptides, computed if None
+
+        Returns: sparse matrix containing the imputed peptides
+        """
+        rng = np.random.default_rng(rng)
+
+        if statistics is None:
+            statistics = self._column_statistics(peptides, remaining_peptides)
+        zero_counts, _, means, number_of_rows = statistics
+        non_zero_counts = number_of_rows - zero_counts
+
+        missing_percentages = 1 - non_zero_counts / number_of_rows
+        missing_counts = (missing_percentages * number_of_samples).astype(np.int64)
+        non_missing_counts = number_of_samples - missing_counts
+
+        indptr = np.concatenate([[0], np.cumsum(non_missing_counts)])
+        indices = np.empty(indptr[-1], dtype=np.int64)
+        for i, count in enumerate(non_missing_counts):
+            indices[indptr[i]:indptr[i + 1]] = np.sort(
+                rng.choice(number_of_samples, size=count, replace=False)
+            )
+        values = np.repeat(means, non_missing_counts)
+
+        return sparse.csc_array(
+            (values, indices, indptr), shape=(number_of_samples, len(remaining_peptides))
         )
 
+    def _impute_peptides(
+            self,
+            peptides: pl.DataFrame | pl.LazyFrame,
+            remaining_peptides: list[str],
+            number_of_samples: int,
+            rng: np.random.Generator | None = None,
+            statistics: tuple[np.ndarray, np.ndarray, np.ndarray, int] | None = None,
+    ) -> pl.DataFrame:
+        """
+        impute peptides which were not modeled
+        Each column holds its original mean in exactly as many rows as needed to keep the original
+        share of non-zero values and 0.0 elsewhere.
+        Args:
+            peptides: original peptide data
+            remaining_peptides: peptides which should be imputed
+            number_of_samples: number of synthetic patients
+            rng: random number generator used for the imputation mask
+            statistics: `_column_statistics` of the remaining peptides, computed if None
+
+        Returns: dataframe containing the imputed peptides
+        """
+        rng = np.random.default_rng(rng)
+
+        # zero counts and means of all columns are computed together, nulls are counted as non-zero values
+        if statistics is None:
+            statistics = self._column_statistics(peptides, remaining_peptides)
+        zero_counts, _, means, number_of_rows = statistics
+        non_zero_counts = number_of_rows - zero_counts
+
+        missing_percentages = 1 - non_zero_counts / number_of_rows
+        missing_counts = (missing_percentages * number_of_samples).astype(np.int64)
+        non_missing_counts = number_of_samples - missing_counts
+
+        # every column gets an independent random permutation of the row ranks,
+        # rows ranked below the non-missing count receive the mean
+        index_dtype = np.int32 if number_of_samples < np.iinfo(np.int32).max else np.int64
+        ranks = np.repeat(
+            np.arange(number_of_samples, dtype=index_dtype)[:, None], len(remaining_peptides), axis=1
+        )
+        rng.permuted(ranks, axis=0, out=ranks)
+        values = np.where(ranks < non_missing_counts, means, 0.0)
+
+        return pl.DataFrame(values, schema=remaining_peptides)
+
     def get_peptides_for_modelling(
-            self, data: pl.DataFrame, missing_threshold: float
+            self,
+            data: pl.DataFrame | pl.LazyFrame | SparsePeptides,
+            missing_threshold: float,
+            column_chunk_size: int = 1000,
     ) -> tuple[pl.DataFrame, list[str]]:
         """
         filters peptides which pass the frequency threshold needed to apply copulas to them
+        For a lazy frame the selection is done in two passes. The first pass computes the share of missing
+        values in chunks of `column_chunk_size` columns and the second one reads only the columns that will
+        be modelled, so peak memory scales with the modelled subset instead of the full table width.
+        Sparse peptide data is only densified for the modelled subset.
         Args:
-            data: peptide data in a polars dataframe
+            data: peptide data in a polars dataframe, lazy frame or sparse peptide data
             missing_threshold: if the missing data percentage goes above this value, copulas are not used
+            column_chunk_size: number of columns aggregated at once in the first pass over a lazy frame
 
         Returns: polars dataframe of peptides for copula fitting and list of the remaining column names
 
         """
-        # Replace 0 with None
-        data = data.with_columns(
-            [
-                pl.when(pl.col(col) == 0).then(None).otherwise(pl.col(col)).alias(col)
-                for col in data.columns
-            ]
-        )
+        schema = data.collect_schema()
+        columns = schema.names()
 
-        # Calculate the percentage of missing values in each column
-        missing_values_percentages = data.select(
-            pl.all().null_count() / pl.len()
-        ).to_dict(as_series=False)
+        # Calculate the percentage of missing (zero or null) values in each column
+        zero_counts, null_counts, _, number_of_rows = self._column_statistics(
+            data, columns, column_chunk_size
+        )
+        missing_values_percentages = (zero_counts + null_counts) / number_of_rows
 
         # Identify columns with missing values below the threshold
         columns_to_model = [
             col
-            for col, perc in missing_values_percentages.items()
-            if perc[0] <= missing_threshold
+            for col, perc in zip(columns, missing_values_percentages)
+            if perc <= missing_threshold
         ]
 
-        other_columns = set(data.columns) - set(columns_to_model)
+        modelled_columns = set(columns_to_model)
+        other_columns = [col for col in columns if col not in modelled_columns]
 
         print(
             f"{len(columns_to_model) - 1} columns will be synthesized using advanced methods!"
@@ -134,29 +572,76 @@ class Processor(ABC):
             f"{len(other_columns)} will be approximated using the mean as there is not enough data!"
         )
 
-        # Select columns to model
-        original_types = {col: data[col].dtype for col in columns_to_model}
+        # Select columns to model, zeros are replaced with None
         column_transformations = []
         for col in columns_to_model:
-            dtype = original_types[col]
+            dtype = schema[col]
+            column = pl.when(pl.col(col) == 0).then(None).otherwise(pl.col(col))
 
             if col == self.primary_key:
                 # Handle primary key column based on its original type
                 if dtype in [pl.Float64, pl.Int64]:
                     column_transformations.append(
-                        pl.col(col).cast(pl.Int64).alias(col)
+                        column.cast(pl.Int64).alias(col)
                     )
                 elif dtype == pl.Utf8:
                     column_transformations.append(
-                        pl.col(col).cast(pl.Utf8).alias(col)
+                        column.cast(pl.Utf8).alias(col)
                     )
                 else:
                     raise ValueError(f"Unsupported type for primary key column '{col}': {dtype}")
             else:
                 column_transformations.append(
-                    pl.col(col).cast(pl.Float64)
+                    column.cast(pl.Float64).alias(col)
                 )
-        # Apply transformations
-        df = data.select(columns_to_model).with_columns(column_transformations)
+        # Apply transformations, only the modelled columns are read from a lazy frame
+        if isinstance(data, SparsePeptides):
+            data = data.to_frame(columns_to_model)
+        df = data.lazy().select(column_transformations).collect()
+
+        return df, other_columns
 
-        return df, list(other_columns)
+    @staticmethod
+    def _column_statistics(
+            data: pl.DataFrame | pl.LazyFrame | SparsePeptides,
+            columns: list[str],
+            column_chunk_size: int | None = 1000,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+        """
+        count zero and null values and compute the mean of each column
+        Columns of a lazy frame are aggregated in chunks, each chunk projects only its own columns
+        so the full table is never materialized. A dataframe is aggregated in a single query and
+        sparse peptide data is aggregated directly on the stored values.
+        Args:
+            data: peptide data in a polars dataframe, lazy frame or sparse peptide data
+            columns: columns to aggregate
+            column_chunk_size: number of columns aggregated at once in a lazy frame, None aggregates all
+
+        Returns: zero counts, null counts and means of the columns and the number of rows
+        """
+        if isinstance(data, SparsePeptides):
+            return *data.column_statistics(columns), data.height
+
+        if isinstance(data, pl.DataFrame) or column_chunk_size is None:
+            column_chunk_size = max(len(columns), 1)
+
+        zero_counts, null_counts, means = [], [], []
+        for start in range(0, len(columns), column_chunk_size):
+            chunk = columns[start:start + column_chunk_size]
+            statistics = data.lazy().select(
+                (pl.col(chunk) == 0).sum().name.suffix("_zero_count"),
+                pl.col(chunk).null_count().name.suffix("_null_count"),
+                pl.col(chunk).mean().name.suffix("_mean"),
+            ).collect().row(0)
+            zero_counts.extend(statistics[:len(chunk)])
+            null_counts.extend(statistics[len(chunk):2 * len(chunk)])
+            means.extend(statistics[2 * len(chunk):])
+
+        number_of_rows = data.lazy().select(pl.len()).collect().item()
+
+        return (
+            np.array(zero_counts, dtype=np.int64),
+            np.array(null_counts, dtype=np.int64),
+            np.array(means, dtype=np.float64),
+            number_of_rows,
+        )
@@ -23,13 +23,29 @@ class HFProcessorForSynthetization(Processor):
         data = self._preprocess_clinical_data(data)
         data = self._preprocess_peptide_data(data)
 
-        # we exclude patients which contain null values
-        valid_clinical_ids = data.clinical.drop_nulls()[self.primary_key].to_list()
-        valid_peptides_ids = data.peptides.drop_nulls()[self.primary_key].to_list()
-        valid_ids = set(valid_clinical_ids).intersection(set(valid_peptides_ids))
-        print(len(valid_ids))
-        data.clinical = data.clinical.filter(pl.col(self.primary_key).is_in(valid_ids))
-        data.peptides = data.peptides.filter(pl.col(self.primary_key).is_in(valid_ids))
+        # we exclude patients which contain null values, valid ids are intersected with a
+        # semi-join so the keys never leave polars
+        lazy_peptides = isinstance(data.peptides, pl.LazyFrame)
+        valid_ids = (
+            data.clinical.lazy()
+            .drop_nulls()
+            .select(self.primary_key)
+            .join(
+                data.peptides.lazy().drop_nulls().select(self.primary_key),
+                on=self.primary_key,
+                how="semi",
+            )
+            .collect(streaming=lazy_peptides)
+        )
+        print(valid_ids[self.primary_key].n_unique())
+        data.clinical = data.clinical.join(valid_ids, on=self.primary_key, how="semi")
+        if lazy_peptides:
+            # joins are not streamed, a membership filter keeps lazy peptides streamable
+            data.peptides = data.peptides.filter(
+                pl.col(self.primary_key).is_in(valid_ids[self.primary_key])
+            )
+        else:
+            data.peptides = data.peptides.join(valid_ids, on=self.primary_key, how="semi")
         return data
 
     def _preprocess_clinical_data(self, data: Data) -> Data:
@@ -56,7 +72,7 @@ class HFProcessorForSynthetization(Processor):
         Returns: preprocessed data
         """
         data.peptides = data.peptides.select(
-            [pl.col(col) for col in data.peptides.columns if col != ""]
+            [pl.col(col) for col in data.peptides.collect_schema().names() if col != ""]
         )
         data.peptides = data.peptides.with_columns(
             (pl.col(self.primary_key) / 1000).cast(pl.Int64)
@@ -1,37 +1,128 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import hashlib
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 
 
-def concatenate_tables_from_files(path: str, filenames: list[str]) -> pd.DataFrame:
+def convert_excel_table(excel_path: str, cache_dir: str) -> str:
+    """
+    read a single excel table, transpose it and store it as a parquet file
+    The cached file name is derived from the path, modification time and size of the excel
+    table, so tables which did not change since the last conversion are not parsed again.
+    Args:
+        excel_path: path to the Excel table
+        cache_dir: directory where converted tables are stored
+
+    Returns: path to the converted table
+    """
+    stat = os.stat(excel_path)
+    signature = f"{os.path.abspath(excel_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    digest = hashlib.sha1(signature.encode()).hexdigest()[:16]
+    cached_path = os.path.join(cache_dir, f"{Path(excel_path).stem}-{digest}.parquet")
+    if os.path.exists(cached_path):
+        return cached_path
+
+    data = pd.read_excel(excel_path, header=1)
+    transpose_data = data.T
+    transpose_data.columns = [str(column) for column in transpose_data.iloc[0]]
+    transpose_data = transpose_data[1:].reset_index().infer_objects()
+    # columns mixing numbers with text such as "n.d." are kept as the text pandas writes for them
+    mixed_columns = transpose_data.columns[transpose_data.dtypes == object]
+    transpose_data[mixed_columns] = transpose_data[mixed_columns].astype("string")
+
+    # write to a temporary file first so an interrupted conversion is never reused
+    tmp_path = cached_path + f".{os.getpid()}.tmp"
+    pq.write_table(pa.Table.from_pandas(transpose_data, preserve_index=False), tmp_path)
+    os.replace(tmp_path, cached_path)
+
+    # drop conversions of older versions of the same table
+    for stale_path in Path(cache_dir).glob(f"{Path(excel_path).stem}-*.parquet"):
+        if stale_path.stem.rsplit("-", 1)[0] == Path(excel_path).stem and str(stale_path) != cached_path:
+            stale_path.unlink(missing_ok=True)
+    return cached_path
+
+
+def convert_excel_tables(
+    path: str,
+    filenames: list[str],
+    cache_dir: str,
+    max_workers: int | None = None,
+) -> dict[str, str]:
+    """
+    convert multiple excel tables to cached parquet files using a pool of processes
+    Args:
+        path: path to the root directory containing the Excel tables
+        filenames: filenames of the Excel tables
+        cache_dir: directory where converted tables are stored
+        max_workers: number of worker processes, if None the number of CPUs is used
+
+    Returns: dictionary mapping the filename to the converted table, missing tables are skipped
+    """
+    Path(cache_dir).mkdir(exist_ok=True, parents=True)
+    excel_paths = {}
+    for filename in dict.fromkeys(filenames):
+        filename_path = os.path.join(path, (filename + ".xlsx"))
+        if os.path.exists(filename_path):
+            excel_paths[filename] = filename_path
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        converted = executor.map(
+            convert_excel_table, excel_paths.values(), [cache_dir] * len(excel_paths)
+        )
+        return dict(zip(excel_paths.keys(), converted))
+
+
+def concatenate_tables_from_files(
+    path: str,
+    filenames: list[str],
+    cache_dir: str | None = None,
+    max_workers: int | None = None,
+    converted: dict[str, str] | None = None,
+) -> pd.DataFrame:
     """
     concatenate multiple excel tables into a single resulting pandas dataframe
     Args:
         path: path to the root directory containing the Excel tables
         filenames: filenames of the Excel tables
+        cache_dir: directory where converted tables are cached, defaults to `<path>/.excel_cache`
+        max_workers: number of worker processes used to convert the Excel tables
+        converted: result of `convert_excel_tables` if the tables are already converted
 
     Returns: dataframe containing the concatenated tables
     """
-    tables = []
-    for i in range(len(filenames)):
-        filename_path = os.path.join(path, (filenames[i] + ".xlsx"))
-        if not os.path.exists(filename_path):
-            continue
-        data = pd.read_excel(filename_path, header=1)
-        transpose_data = data.T
-        transpose_data.columns = transpose_data.iloc[0]
-        transpose_data = transpose_data[1:]
-        tables.append(transpose_data)
-    new_table = pd.concat(tables)
+    if converted is None:
+        if cache_dir is None:
+            cache_dir = os.path.join(path, ".excel_cache")
+        converted = convert_excel_tables(path, filenames, cache_dir, max_workers)
+
+    # tables may contain different peptides, missing columns are filled with nulls
+    tables = [pq.read_table(converted[filename]) for filename in filenames if filename in converted]
+    try:
+        new_table = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # a column with numbers in one table and text in another is merged by pandas as object
+        new_table = pd.concat([table.to_pandas() for table in tables])
+    new_table = new_table.set_index("index")
+    new_table.index.name = None
     return new_table
 
 
-def merge_hf_data(root_dir_path: str, save_dir_path: str):
+def merge_hf_data(
+    root_dir_path: str,
+    save_dir_path: str,
+    cache_dir: str | None = None,
+    max_workers: int | None = None,
+):
     """
     This script is used to merge the heart failure data used in the research.
     This is a custom script and is not reproducible for data of a different type.
     :param root_dir_path: path to the directory where all excel tables used for research are located
     :param save_dir_path: path to the directory where the merged data will be saved
+    :param cache_dir: directory where converted Excel tables are cached
+    :param max_workers: number of worker processes used to convert the Excel tables
     """
     # Check if the directory exists and is not empty
     if Path(root_dir_path).exists() and any(Path(root_dir_path).iterdir()):
@@ -44,6 +135,25 @@ def merge_hf_data(root_dir_path: str, save_dir_path: str):
             filenames_data.columns[[4, 5, 6, 7, 8, 9]], axis=1
         )
         clin_data = pd.read_excel(excel_data, sheet_name="clin.data")
+        if cache_dir is None:
+            cache_dir = os.path.join(root_dir_path, ".excel_cache")
+
+        # convert all HF and no-event peptide tables in a single parallel pass
+        hf_filenames = filenames_data[filenames_data["Group"] == "HF"][
+            "File name"
+        ].unique()
+        no_event_filenames = filenames_data[
+            filenames_data["Group"].isin(
+                ["no_event_1", "no_event_2", "no_event_3", "no_event_4", "no_event_5"]
+            )
+        ]["File name"].unique()
+        print("Converting peptide tables")
+        converted = convert_excel_tables(
+            root_dir_path,
+            list(hf_filenames) + list(no_event_filenames),
+            cache_dir,
+            max_workers,
+        )
 
         # Process HF clinical data
         print("HF clinical data processing and saving")
@@ -57,11 +167,8 @@ def merge_hf_data(root_dir_path: str, save_dir_path: str):
 
         # Process HF peptide data
         print("HF peptide data processing and saving")
-        hf_filenames = filenames_data[filenames_data["Group"] == "HF"][
-            "File name"
-        ].unique()
         hf_peptides_data_merged = concatenate_tables_from_files(
-            root_dir_path, hf_filenames
+            root_dir_path, hf_filenames, converted=converted
         )
         df_reset = hf_peptides_data_merged.reset_index()
         df_reset.rename(columns={"index": "idAuswertung"}, inplace=True)
@@ -97,13 +204,8 @@ def merge_hf_data(root_dir_path: str, save_dir_path: str):
 
         # Process no-event peptide data (CKD peptide data is a subset of non-event peptide data)
         print("no-event and cdk peptide data processing and saving")
-        no_event_filenames = filenames_data[
-            filenames_data["Group"].isin(
-                ["no_event_1", "no_event_2", "no_event_3", "no_event_4", "no_event_5"]
-            )
-        ]["File name"].unique()
         no_event_peptides_data = concatenate_tables_from_files(
-            root_dir_path, no_event_filenames
+            root_dir_path, no_event_filenames, converted=converted
         )
         df_ne_reset = no_event_peptides_data.reset_index()
         df_ne_reset.rename(columns={"index": "idAuswertung"}, inplace=True)
@@ -0,0 +1,227 @@
+import numpy as np
+from fitter import Fitter
+from scipy import stats
+
+# distributions whose parameters are estimated for all columns at once
+BATCHED_DISTRIBUTIONS = ("norm", "lognorm")
+
+# number of histogram bins used by Fitter to compute the sum of squared errors
+HISTOGRAM_BINS = 100
+
+
+def pack_columns(columns: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    pack columns of different lengths into a single NaN padded matrix
+    Args:
+        columns: values of every column
+    Returns: matrix of shape (number of columns, longest column) and the number of values in each column
+    """
+    counts = np.array([len(column) for column in columns], dtype=np.int64)
+    values = np.full((len(columns), counts.max(initial=0)), np.nan)
+    for i, column in enumerate(columns):
+        values[i, :len(column)] = column
+    return values, counts
+
+
+def shared_histograms(values: np.ndarray, counts: np.ndarray, bins: int = HISTOGRAM_BINS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    density histograms of all columns, computed the same way as `np.histogram` and Fitter
+    Every distribution fitted to a column is scored against the same bins.
+    Args:
+        values: NaN padded matrix of column values
+        counts: number of values in each column
+        bins: number of equal width bins
+    Returns: bin centers and densities, both of shape (number of columns, bins)
+    """
+    first_edge = np.nanmin(values, axis=1)
+    last_edge = np.nanmax(values, axis=1)
+    # np.histogram widens the range of constant data
+    constant = first_edge == last_edge
+    first_edge = np.where(constant, first_edge - 0.5, first_edge)
+    last_edge = np.where(constant, last_edge + 0.5, last_edge)
+
+    edges = np.linspace(first_edge, last_edge, bins + 1, axis=1)
+    valid = ~np.isnan(values)
+
+    # bin index of every value, including the rounding corrections of np.histogram
+    scaled = (values - first_edge[:, None]) / (last_edge - first_edge)[:, None] * bins
+    indices = np.where(valid, scaled, 0).astype(np.intp)
+    indices[indices == bins] -= 1
+    rows = np.arange(len(values))[:, None]
+    indices[values < edges[rows, indices]] -= 1
+    indices[(values >= edges[rows, indices + 1]) & (indices != bins - 1)] += 1
+
+    flat_indices = (indices + rows * bins)[valid]
+    histogram = np.bincount(flat_indices, minlength=len(values) * bins).reshape(len(values), bins)
+
+    densities = histogram / np.diff(edges, axis=1) / counts[:, None]
+    centers = (edges[:, :-1] + edges[:, 1:]) / 2.0
+    return centers, densities
+
+
+def _fit_norm(values: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """maximum likelihood estimates of the normal distribution, as in `scipy.stats.norm.fit`"""
+    loc = np.nansum(values, axis=1) / counts
+    scale = np.sqrt(np.nansum((values - loc[:, None]) ** 2, axis=1) / counts)
+    failed = ~(np.isfinite(loc) & np.isfinite(scale))
+    return np.stack([loc, scale], axis=1), failed
+
+
+def _fit_lognorm(values: np.ndarray, counts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    maximum likelihood estimates of the three parameter lognormal distribution
+    Follows `scipy.stats.lognorm.fit`: shape and scale have closed forms for a given location, and the
+    location is the root of the profile log-likelihood derivative. The bracket search and the root search
+    run for all columns together, columns where SciPy would fall back to its generic optimizer are flagged.
+    """
+    data_min = np.nanmin(values, axis=1)
+
+    def shape_scale(loc, rows):
+        log_data = np.log(values[rows] - loc[:, None])
+        scale = np.exp(np.nansum(log_data, axis=1) / counts[rows])
+        shape = np.sqrt(np.nansum((log_data - np.log(scale)[:, None]) ** 2, axis=1) / counts[rows])
+        return shape, scale
+
+    def derivative(loc, rows):
+        shape, scale = shape_scale(loc, rows)
+        shifted = values[rows] - loc[:, None]
+        return np.nansum((1 + np.log(shifted / scale[:, None]) / shape[:, None] ** 2) / shifted, axis=1)
+
+    def log_likelihood(loc, rows):
+        shape, scale = shape_scale(loc, rows)
+        log_pdf = stats.lognorm.logpdf(values[rows], shape[:, None], loc[:, None], scale[:, None])
+        return np.nansum(log_pdf, axis=1)
+
+    everything = np.arange(len(values))
+    with np.errstate(all="ignore"):
+        spacing = np.spacing(data_min)
+        upper = data_min - spacing
+        upper_derivative = derivative(upper, everything)
+        upper_log_likelihood = log_likelihood(upper, everything)
+
+        # the derivative has to be negative at the upper end of the bracket
+        delta = 2 * spacing
+        active = upper_derivative >= -1e-6
+        while active.any():
+            rows = everything[active]
+            upper[rows] = data_min[rows] - delta[rows]
+            upper_derivative[rows] = derivative(upper[rows], rows)
+            delta[rows] *= 2
+            active[rows] = upper_derivative[rows] >= -1e-6
+        failed = ~(np.isfinite(upper) & np.isfinite(upper_derivative))
+
+        # the lower end of the bracket is moved down until the sign of the derivative changes
+        lower = np.minimum(np.nextafter(upper, -np.inf), upper - 1)
+        lower_derivative = derivative(lower, everything)
+        delta = 2 * (upper - lower)
+        active = ~failed & np.isfinite(lower) & np.isfinite(lower_derivative) & (
+            np.sign(lower_derivative) == np.sign(upper_derivative)
+        )
+        while active.any():
+            rows = everything[active]
+            lower[rows] = upper[rows] - delta[rows]
+            lower_derivative[rows] = derivative(lower[rows], rows)
+            delta[rows] *= 2
+            active[rows] = np.isfinite(lower[rows]) & np.isfinite(lower_derivative[rows]) & (
+                np.sign(lower_derivative[rows]) == np.sign(upper_derivative[rows])
+            )
+        failed |= ~(np.isfinite(lower) & np.isfinite(lower_derivative))
+
+        # bisection to the tolerance of scipy.optimize.brentq
+        low, high = lower.copy(), upper.copy()
+        low_positive = lower_derivative > 0
+        active = ~failed
+        while active.any():
+            rows = everything[active]
+            middle = (low[rows] + high[rows]) / 2
+            middle_positive = derivative(middle, rows) > 0
+            move_low = middle_positive == low_positive[rows]
+            low[rows] = np.where(move_low, middle, low[rows])
+            high[rows] = np.where(move_low, high[rows], middle)
+            tolerance = 2e-12 + 4 * np.finfo(float).eps * np.abs(middle)
+            active[rows] = np.abs(high[rows] - low[rows]) > tolerance
+        root = (low + high) / 2
+
+        # the maximum can also be at the minimum of the data instead of at the root
+        root_log_likelihood = log_likelihood(np.where(failed, upper, root), everything)
+        loc = np.where(root_log_likelihood > upper_log_likelihood, root, data_min - spacing)
+        shape, scale = shape_scale(loc, everything)
+
+    failed |= ~((shape > 0) & np.isfinite(shape) & (scale > 0) & np.isfinite(scale))
+    return np.stack([shape, loc, scale], axis=1), failed
+
+
+_BATCHED_ESTIMATORS = {
+    "norm": _fit_norm,
+    "lognorm": _fit_lognorm,
+}
+
+
+def _parameter_names(distribution: str) -> list[str]:
+    """parameter names in the order returned by `fit`, as reported by `Fitter.get_best`"""
+    shapes = getattr(stats, distribution).shapes
+    return (shapes + ", loc, scale").split(", ") if shapes else ["loc", "scale"]
+
+
+def fit_distributions_batched(
+    columns: list[np.ndarray],
+    distribution_list: list[str],
+    method: str,
+) -> list[tuple[str, dict[str, float]]]:
+    """
+    choose the best distribution for every column, fitting all columns at once where possible
+    Columns are packed into a NaN padded matrix. Normal and lognormal parameters are estimated for all
+    columns together and scored the same way as Fitter does: sum of squared errors against the density
+    histogram of the column, AIC and BIC from the log-likelihood at the bin centers. Distributions without a
+    batched estimator, and columns where a batched estimate fails, are fitted one by one like in Fitter.
+    Args:
+        columns: non-zero values of every column
+        distribution_list: list of allowed distributions
+        method: metric which should be used to choose the best fitting distribution
+    Returns: name and parameters of the best distribution for every column
+    """
+    values, counts = pack_columns(columns)
+    centers, densities = shared_histograms(values, counts)
+
+    scores = {name: np.full((len(columns), len(distribution_list)), np.inf) for name in ("sumsquare_error", "aic", "bic")}
+    parameters = [[None] * len(distribution_list) for _ in columns]
+
+    for j, distribution in enumerate(distribution_list):
+        if distribution in _BATCHED_ESTIMATORS:
+            params, failed = _BATCHED_ESTIMATORS[distribution](values, counts)
+            ok = np.flatnonzero(~failed)
+            dist = getattr(stats, distribution)
+            with np.errstate(all="ignore"):
+                pdf = dist.pdf(centers[ok], *(params[ok, i, None] for i in range(params.shape[1])))
+                log_likelihood = np.sum(
+                    dist.logpdf(centers[ok], *(params[ok, i, None] for i in range(params.shape[1]))), axis=1
+                )
+            number_of_params = params.shape[1]
+            scores["sumsquare_error"][ok, j] = np.sum((pdf - densities[ok]) ** 2, axis=1)
+            scores["aic"][ok, j] = 2 * number_of_params - 2 * log_likelihood
+            scores["bic"][ok, j] = number_of_params * np.log(counts[ok]) - 2 * log_likelihood
+            for i in ok:
+                parameters[i][j] = tuple(params[i])
+            generic_rows = np.flatnonzero(failed)
+        else:
+            generic_rows = range(len(columns))
+
+        for i in generic_rows:
+            _, result = Fitter._fit_single_distribution(
+                distribution, columns[i], list(centers[i]), densities[i], 30
+            )
+            if result is not None:
+                parameters[i][j] = result[0]
+                scores["sumsquare_error"][i, j], scores["aic"][i, j], scores["bic"][i, j] = result[2:5]
+
+    method_scores = np.where(np.isnan(scores[method]), np.inf, scores[method])
+    best = np.argmin(method_scores, axis=1)
+
+    results = []
+    for i, j in enumerate(best):
+        distribution = distribution_list[j]
+        params = parameters[i][j] if parameters[i][j] is not None else ()
+        results.append(
+            (distribution, dict(zip(_parameter_names(distribution), (float(p) for p in params))))
+        )
+    return results
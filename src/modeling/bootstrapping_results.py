@@ -4,6 +4,7 @@ import numpy as np
 from scipy.stats import ks_2samp
 from scipy.stats import gaussian_kde
 from copy import deepcopy
+from pathlib import Path
 from tqdm import tqdm
 
 
@@ -87,3 +88,81 @@ def bootstrapping_data(
 
 
 
+
+
+def bootstrap_synthetic_data(
+        save_path: str,
+        peptide_data_path: str,
+        primary_key: str,
+        nonzero_threshold: float = 0.6,
+        sample_size: int = 182,
+        iteration_number: int = 500,
+        n_jobs=-1
+):
+    """
+    choose the bootstrap sample of the saved synthetic data which is closest to the real peptides,
+    then save the sample of both tables and its statistics next to the synthetic data
+    Args:
+        save_path: directory containing the synthetic data
+        peptide_data_path: path to the real peptide data
+        primary_key: primary key column name
+        nonzero_threshold: peptides with less zero values than this share are compared
+        sample_size: number of patients in the bootstrap sample
+        iteration_number: number of bootstrap samples
+        n_jobs: number of processes comparing samples, all CPU cores if -1
+    """
+    print(nonzero_threshold)
+    print("#### Bootstrapping started ####")
+    path_to_synth_table = Path(save_path, "synthetic_data_peptides.csv")
+    best_seed, statistic = bootstrapping_data(
+        path_to_synth_table,
+        peptide_data_path,
+        nonzero_threshold,
+        sample_size,
+        iteration_number,
+        n_jobs,
+    )
+    data = pd.read_csv(path_to_synth_table).sample(sample_size, random_state=best_seed)
+
+    # Saving bootstrapped peptides data
+    print("#### Saving bootstrapped data ####")
+    data.to_csv(
+        Path(save_path, "synthetic_data_peptides_bootstrapped.csv"),
+        header=True,
+        index=False
+    )
+
+    # select sample ids
+    sample_ids = data[primary_key]  # Adjust 'id' to match your actual column name for IDs
+
+    # load clinical data
+    path_to_clin_table = Path(save_path, "synthetic_data_clinical.csv")
+    clinical = pd.read_csv(path_to_clin_table)
+
+    # Filter clinical table
+    clinical_sample = clinical[clinical[primary_key].isin(sample_ids)]
+
+    # Saving bootstrapped clinical data
+    clinical_sample.to_csv(
+        Path(save_path, "synthetic_data_clinical_bootstrapped.csv"),
+        header=True,
+        index=False
+    )
+
+    # save statistic
+    print("#### Saving statistic ####")
+    stat = [
+        {'Peptide_id': peptide_id,
+         'kl_divergence': values['kl_divergence'],
+         'ks_p-value': values['ks_p-value']}
+        for peptide_id, values in statistic.items()
+    ]
+    # Convert the list of dictionaries into a pandas DataFrame
+    df = pd.DataFrame(stat)
+
+    # Save the DataFrame to a CSV file
+    df.to_csv(
+        Path(save_path, "synthetic_data_peptides_statistic.csv"),
+        header=True,
+        index=False
+    )
@@ -0,0 +1,343 @@
+from abc import ABC, abstractmethod
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from rdt.transformers.utils import learn_rounding_digits
+from scipy.special import expit, logit
+
+# transformed proportions are kept away from 0 and 1, so their logit stays finite
+EPSILON = np.finfo(np.float32).eps
+
+
+class Constraint(ABC):
+    def __init__(self, column: str, strict_boundaries: bool = False):
+        """
+        Abstract deterministic constraint which is enforced by reparameterizing a single column
+        The column is replaced by an unconstrained value before fitting, and every sampled value maps back
+        to a valid one, so no sampled row has to be rejected.
+        Args:
+            column: column which is transformed
+            strict_boundaries: if True, boundaries are excluded from the valid values
+        """
+        self.column = column
+        self.strict_boundaries = strict_boundaries
+        self.dtype = None
+        self.digits = None
+
+    @property
+    def base_columns(self) -> list[str]:
+        """columns the transformed column is expressed relative to"""
+        return []
+
+    def fit(self, data: pd.DataFrame) -> int:
+        """
+        learn the dtype and rounding of the transformed column
+        Args:
+            data: real data
+
+        Returns: number of rows violating the constraint
+        """
+        self.dtype = data[self.column].dtype
+        self.digits = learn_rounding_digits(data[self.column].dropna().astype(np.float64))
+        return int(np.sum(self._is_violated(data)))
+
+    def reverse_transform(self, data: pd.DataFrame) -> None:
+        """
+        restore valid values of the transformed column in place, the base columns have to be restored already
+        Args:
+            data: sampled data
+        """
+        values = self._reverse_transform(data)
+        if self.digits is not None:
+            values = np.round(values, self.digits)
+        values = self._enforce_boundaries(data, values)
+
+        if pd.api.types.is_integer_dtype(self.dtype) and not np.isnan(values).any():
+            values = values.astype(self.dtype)
+        data[self.column] = values
+
+    @property
+    def _step(self) -> float:
+        """smallest distance to a strict boundary which survives rounding"""
+        return 10.0 ** -self.digits if self.digits is not None else np.finfo(np.float64).eps
+
+    def _lower_bound(self, bound: np.ndarray | float) -> np.ndarray | float:
+        """smallest valid value above a lower boundary with the rounding of the transformed column"""
+        bound = bound + self._step if self.strict_boundaries else bound
+        if self.digits is None:
+            return bound
+        # the product is rounded first so representation errors do not move the bound a whole step
+        return np.ceil(np.round(bound * 10.0 ** self.digits, 6)) / 10.0 ** self.digits
+
+    def _upper_bound(self, bound: np.ndarray | float) -> np.ndarray | float:
+        """largest valid value below an upper boundary with the rounding of the transformed column"""
+        bound = bound - self._step if self.strict_boundaries else bound
+        if self.digits is None:
+            return bound
+        return np.floor(np.round(bound * 10.0 ** self.digits, 6)) / 10.0 ** self.digits
+
+    @abstractmethod
+    def _is_violated(self, data: pd.DataFrame) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def transform(self, original: pd.DataFrame) -> np.ndarray:
+        """
+        unconstrained values of the transformed column
+        Args:
+            original: real data before any constraint was applied
+
+        Returns: transformed values
+        """
+        pass
+
+    @abstractmethod
+    def _reverse_transform(self, data: pd.DataFrame) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def _enforce_boundaries(self, data: pd.DataFrame, values: np.ndarray) -> np.ndarray:
+        pass
+
+
+class Inequality(Constraint):
+    def __init__(self, low_column_name: str, high_column_name: str, strict_boundaries: bool = False):
+        """
+        high column is greater than the low column, it is modelled as log(1 + high - low)
+        Args:
+            low_column_name: column with the lower values
+            high_column_name: column with the higher values
+            strict_boundaries: if True, values of the two columns are never equal
+        """
+        super().__init__(high_column_name, strict_boundaries)
+        self.low_column_name = low_column_name
+
+    @property
+    def base_columns(self) -> list[str]:
+        return [self.low_column_name]
+
+    def _is_violated(self, data: pd.DataFrame) -> np.ndarray:
+        difference = _values(data, self.column) - _values(data, self.low_column_name)
+        return difference <= 0 if self.strict_boundaries else difference < 0
+
+    def transform(self, original: pd.DataFrame) -> np.ndarray:
+        difference = _values(original, self.column) - _values(original, self.low_column_name)
+        return np.log1p(np.clip(difference, 0, None))
+
+    def _reverse_transform(self, data: pd.DataFrame) -> np.ndarray:
+        difference = np.clip(np.expm1(_values(data, self.column)), 0, None)
+        return _values(data, self.low_column_name) + difference
+
+    def _enforce_boundaries(self, data: pd.DataFrame, values: np.ndarray) -> np.ndarray:
+        return np.fmax(values, self._lower_bound(_values(data, self.low_column_name)))
+
+
+class ScalarInequality(Constraint):
+    _RELATIONS = (">", ">=", "<", "<=")
+
+    def __init__(self, column_name: str, relation: str, value: float):
+        """
+        column is compared to a fixed value, it is modelled as the log of one plus the distance to the value
+        Args:
+            column_name: constrained column
+            relation: one of '>', '>=', '<' and '<=', e.g. '>' means column > value
+            value: fixed value
+        """
+        if relation not in self._RELATIONS:
+            raise ValueError(f"Relation '{relation}' has to be one of {self._RELATIONS}.")
+        super().__init__(column_name, strict_boundaries=relation in (">", "<"))
+        self.value = value
+        self.sign = 1.0 if relation.startswith(">") else -1.0
+
+    def _is_violated(self, data: pd.DataFrame) -> np.ndarray:
+        distance = self.sign * (_values(data, self.column) - self.value)
+        return distance <= 0 if self.strict_boundaries else distance < 0
+
+    def transform(self, original: pd.DataFrame) -> np.ndarray:
+        distance = self.sign * (_values(original, self.column) - self.value)
+        return np.log1p(np.clip(distance, 0, None))
+
+    def _reverse_transform(self, data: pd.DataFrame) -> np.ndarray:
+        return self.value + self.sign * np.clip(np.expm1(_values(data, self.column)), 0, None)
+
+    def _enforce_boundaries(self, data: pd.DataFrame, values: np.ndarray) -> np.ndarray:
+        if self.sign > 0:
+            return np.fmax(values, self._lower_bound(self.value))
+        return np.fmin(values, self._upper_bound(self.value))
+
+
+class ScalarRange(Constraint):
+    def __init__(self, column_name: str, low_value: float, high_value: float, strict_boundaries: bool = True):
+        """
+        column lies between two fixed values, it is modelled as the logit of its position in the range
+        Args:
+            column_name: constrained column
+            low_value: lower bound
+            high_value: upper bound
+            strict_boundaries: if True, the bounds themselves are not valid values
+        """
+        super().__init__(column_name, strict_boundaries)
+        self.low_value = low_value
+        self.high_value = high_value
+
+    def _is_violated(self, data: pd.DataFrame) -> np.ndarray:
+        values = _values(data, self.column)
+        if self.strict_boundaries:
+            return (values <= self.low_value) | (values >= self.high_value)
+        return (values < self.low_value) | (values > self.high_value)
+
+    def transform(self, original: pd.DataFrame) -> np.ndarray:
+        position = (_values(original, self.column) - self.low_value) / (self.high_value - self.low_value)
+        return logit(np.clip(position, EPSILON, 1 - EPSILON))
+
+    def _reverse_transform(self, data: pd.DataFrame) -> np.ndarray:
+        return self.low_value + (self.high_value - self.low_value) * expit(_values(data, self.column))
+
+    def _enforce_boundaries(self, data: pd.DataFrame, values: np.ndarray) -> np.ndarray:
+        return np.clip(values, self._lower_bound(self.low_value), self._upper_bound(self.high_value))
+
+
+class Range(Constraint):
+    def __init__(
+            self,
+            low_column_name: str,
+            middle_column_name: str,
+            high_column_name: str,
+            strict_boundaries: bool = True,
+    ):
+        """
+        middle column lies between two other columns, it is modelled as the logit of its position between them
+        Args:
+            low_column_name: column with the lower bounds
+            middle_column_name: constrained column
+            high_column_name: column with the upper bounds
+            strict_boundaries: if True, the bounds themselves are not valid values
+        """
+        super().__init__(middle_column_name, strict_boundaries)
+        self.low_column_name = low_column_name
+        self.high_column_name = high_column_name
+
+    @property
+    def base_columns(self) -> list[str]:
+        return [self.low_column_name, self.high_column_name]
+
+    def _is_violated(self, data: pd.DataFrame) -> np.ndarray:
+        low, values, high = (
+            _values(data, self.low_column_name), _values(data, self.column), _values(data, self.high_column_name)
+        )
+        if self.strict_boundaries:
+            return (values <= low) | (values >= high)
+        return (values < low) | (values > high)
+
+    def transform(self, original: pd.DataFrame) -> np.ndarray:
+        low, high = _values(original, self.low_column_name), _values(original, self.high_column_name)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            position = np.where(high > low, (_values(original, self.column) - low) / (high - low), 0.5)
+        return logit(np.clip(position, EPSILON, 1 - EPSILON))
+
+    def _reverse_transform(self, data: pd.DataFrame) -> np.ndarray:
+        low, high = _values(data, self.low_column_name), _values(data, self.high_column_name)
+        return low + np.clip(high - low, 0, None) * expit(_values(data, self.column))
+
+    def _enforce_boundaries(self, data: pd.DataFrame, values: np.ndarray) -> np.ndarray:
+        lower = self._lower_bound(_values(data, self.low_column_name))
+        upper = self._upper_bound(_values(data, self.high_column_name))
+        # the bounds can be too close to fit a valid value between them after rounding, the lower one wins
+        return np.fmax(np.fmin(values, upper), lower)
+
+
+CONSTRAINT_CLASSES = {
+    "Inequality": Inequality,
+    "ScalarInequality": ScalarInequality,
+    "ScalarRange": ScalarRange,
+    "Range": Range,
+}
+
+
+def _values(data: pd.DataFrame, column: str) -> np.ndarray:
+    """values of a column as floats, nulls become NaN"""
+    return data[column].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+class ConstraintLayer:
+    def __init__(self, constraints: list[dict[str, Any]] | None = None):
+        """
+        deterministic constraints compiled into vectorized transforms
+        Every constraint replaces one column by an unconstrained value before the copula is fitted and maps
+        sampled values back, so every sampled batch satisfies the constraints without reject sampling.
+        Args:
+            constraints: constraints from the configuration, with `constraint_class` and `constraint_parameters`
+        """
+        self.constraints = []
+        for constraint in constraints or []:
+            constraint_class = constraint["constraint_class"]
+            if constraint_class not in CONSTRAINT_CLASSES:
+                raise ValueError(
+                    f"Constraint '{constraint_class}' is not supported, use one of {list(CONSTRAINT_CLASSES)}."
+                )
+            self.constraints.append(CONSTRAINT_CLASSES[constraint_class](**constraint["constraint_parameters"]))
+
+        transformed_columns = [constraint.column for constraint in self.constraints]
+        if len(set(transformed_columns)) != len(transformed_columns):
+            raise ValueError("Every column can only be transformed by a single constraint.")
+        self.violations = {}
+
+    @property
+    def transformed_columns(self) -> list[str]:
+        """columns which are replaced by unconstrained values"""
+        return [constraint.column for constraint in self.constraints]
+
+    def fit_transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        learn the constrained columns, report rows of the real data violating them and transform the data
+        Args:
+            data: real data
+
+        Returns: data with unconstrained values in the transformed columns
+        """
+        self.violations = {}
+        for constraint in self.constraints:
+            name = f"{type(constraint).__name__}({', '.join(map(repr, constraint.base_columns + [constraint.column]))})"
+            self.violations[name] = constraint.fit(data)
+            print(f"Constraint {name} is violated by {self.violations[name]} of {len(data)} real rows.")
+
+        return self.transform(data)
+
+    def transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        replace the constrained columns by unconstrained values, every constraint sees the untransformed data
+        Unconstrained columns are shared with `data` instead of copied.
+        Args:
+            data: real data
+
+        Returns: transformed data
+        """
+        transformed = data.copy(deep=False)
+        for constraint in self.constraints:
+            transformed[constraint.column] = constraint.transform(data)
+        return transformed
+
+    def reverse_transform(self, data: pd.DataFrame) -> pd.DataFrame:
+        """
+        map unconstrained values back to valid values of the constrained columns
+        A constraint is reversed once all columns it is expressed relative to are restored.
+        Args:
+            data: sampled data
+
+        Returns: sampled data satisfying all constraints
+        """
+        restored = data.copy(deep=False)
+        pending = list(self.constraints)
+        while pending:
+            transformed = {constraint.column for constraint in pending}
+            ready = [
+                constraint for constraint in pending
+                if not transformed.intersection(constraint.base_columns)
+            ]
+            if not ready:
+                raise ValueError("Constraints depend on each other in a cycle.")
+            for constraint in ready:
+                constraint.reverse_transform(restored)
+                pending.remove(constraint)
+        return restored
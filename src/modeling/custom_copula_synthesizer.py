@@ -1,3 +1,10 @@
+import copy
+import logging
+import warnings
+
+import numpy as np
+import pandas as pd
+from copulas import get_instance, multivariate
 from copulas.univariate import (
     BetaUnivariate,
     GammaUnivariate,
@@ -7,9 +14,13 @@ from copulas.univariate import (
     UniformUnivariate,
     StudentTUnivariate,
 )
+from copulas.univariate.base import ScipyModel
 from sdv.single_table import GaussianCopulaSynthesizer
+from sdv.single_table.utils import log_numerical_distributions_error
+
+from src.modeling.custom_univariate import BinnedGaussianKDE, LognormUnivariate, QuantileTableUnivariate
 
-from src.modeling.custom_univariate import LognormUnivariate
+LOGGER = logging.getLogger(__name__)
 
 
 class CustomGaussianCopulaSynthesizer(GaussianCopulaSynthesizer):
@@ -24,10 +35,127 @@ class CustomGaussianCopulaSynthesizer(GaussianCopulaSynthesizer):
         "truncnorm": TruncatedGaussian,
         "gamma": GammaUnivariate,
         "uniform": UniformUnivariate,
-        "gaussian_kde": GaussianKDE,
+        "gaussian_kde": BinnedGaussianKDE,
         "lognorm": LognormUnivariate,
         "t": StudentTUnivariate,  # Include your custom distribution
     }
 
-    def __init__(self, metadata, **kwargs):
+    def __init__(
+            self,
+            metadata,
+            fitted_parameters: dict[str, dict[str, float]] | None = None,
+            quantile_table_tolerance: float | None = None,
+            **kwargs,
+    ):
+        """
+        Args:
+            metadata: metadata describing the table
+            fitted_parameters: already fitted parameters of the marginal distributions, keyed by column name.
+                               Marginals of these columns are not fitted again.
+            quantile_table_tolerance: if given, fitted marginals are sampled by interpolation in quantile
+                                      tables with at most this error in probability, see `QuantileTableUnivariate`
+            **kwargs: extra kwargs for GaussianCopulaSynthesizer
+        """
         super().__init__(metadata, **kwargs)
+        self.fitted_parameters = fitted_parameters or {}
+        self.quantile_table_tolerance = quantile_table_tolerance
+
+    def _fit(self, processed_data):
+        """
+        fit the copula, see `_fit_with_parameters`, and tabulate the fitted marginals if requested
+        Args:
+            processed_data: data to be learned
+        """
+        if not self.fitted_parameters:
+            super()._fit(processed_data)
+        else:
+            self._fit_with_parameters(processed_data)
+
+        if self.quantile_table_tolerance is not None:
+            # the correlation is learned from the exact marginals, only sampling uses the tables
+            self._model.univariates = [
+                QuantileTableUnivariate(univariate, self.quantile_table_tolerance)
+                for univariate in self._model.univariates
+            ]
+
+    def _fit_with_parameters(self, processed_data):
+        """
+        fit the copula, marginals of columns with fitted parameters are set instead of being fitted
+        Mirrors GaussianCopulaSynthesizer._fit and GaussianMultivariate.fit otherwise.
+        Args:
+            processed_data: data to be learned
+        """
+
+        log_numerical_distributions_error(self.numerical_distributions, processed_data.columns, LOGGER)
+        self._num_rows = len(processed_data)
+
+        distributions = {
+            column: self._numerical_distributions.get(column, self._default_distribution)
+            for column in processed_data.columns
+        }
+        self._model = multivariate.GaussianMultivariate(distribution=distributions)
+
+        univariates = []
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", module="scipy")
+            for column_name, column in processed_data.items():
+                univariate = get_instance(distributions[column_name])
+                params = self.fitted_parameters.get(column_name)
+                if params and isinstance(univariate, ScipyModel) and not isinstance(univariate, GaussianKDE):
+                    univariate._set_params(params)
+                    univariate.fitted = True
+                else:
+                    try:
+                        univariate.fit(column)
+                    except BaseException:
+                        # same fallback as GaussianMultivariate.fit
+                        univariate = GaussianUnivariate()
+                        univariate.fit(column)
+                univariates.append(univariate)
+
+            self._model.columns = list(processed_data.columns)
+            self._model.univariates = univariates
+            self._model.correlation = self._model._get_correlation(processed_data)
+            self._model.fitted = True
+
+    def _detach_arrays(self) -> tuple["CustomGaussianCopulaSynthesizer", dict[str, np.ndarray]]:
+        """
+        split the correlation matrix off the synthesizer, `Synthesizer.save` stores it as a .npy file
+        Returns: copy of the synthesizer without the correlation and the correlation keyed by name
+        """
+        model = copy.copy(self)
+        if self._model is None or getattr(self._model, "correlation", None) is None:
+            return model, {}
+        model._model = copy.copy(self._model)
+        model._model.correlation = None
+        return model, {"correlation": self._model.correlation.to_numpy()}
+
+    def _attach_arrays(self, arrays: dict[str, np.ndarray]) -> None:
+        """set the correlation returned by `_detach_arrays`, e.g. memory mapped from a .npy file"""
+        if "correlation" in arrays:
+            columns = self._model.columns
+            self._model.correlation = pd.DataFrame(arrays["correlation"], index=columns, columns=columns, copy=False)
+
+    def set_random_state(self, seed_sequence: np.random.SeedSequence) -> None:
+        """
+        draw the random numbers of the following samples from streams spawned from `seed_sequence`
+        Covers the copula and the random reverse transformations, e.g. the regenerated missing values and
+        the values of anonymized columns.
+        Args:
+            seed_sequence: seed of the samples
+        """
+        self._data_processor.reset_sampling()
+        # the order of the field transformers depends on hash randomization, streams follow the sorted fields
+        field_transformers = self._data_processor._hyper_transformer.field_transformers
+        transformers = [
+            field_transformers[field]
+            for field in sorted(field_transformers, key=str)
+            if field_transformers[field] is not None
+        ]
+        model_seed, *transformer_seeds = seed_sequence.spawn(len(transformers) + 1)
+        self._set_random_state(int(model_seed.generate_state(1)[0]))
+        for transformer, seed in zip(transformers, transformer_seeds):
+            state = seed.generate_state(1)[0]
+            transformer.set_random_state(np.random.RandomState(state), "reverse_transform")
+            if hasattr(transformer, "faker"):
+                transformer.faker.seed_instance(int(state))
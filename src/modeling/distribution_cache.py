@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+# bump whenever the layout of cached entries changes so stale entries are not reused
+CACHE_FORMAT_VERSION = 1
+
+
+class DistributionFitCache:
+    def __init__(self, cache_dir: str | Path, max_entries: int = 100_000):
+        """
+        on-disk cache of fitted marginal distributions with a least recently used size bound
+        Entries are content addressed: the key is a hash of the non-zero values of a column, the candidate
+        distributions and the goodness of fit method, so a column is refitted only if one of them changes.
+        Every entry is a small JSON file holding the chosen distribution and its fitted parameters. Reading
+        an entry refreshes its modification time, and the oldest entries are removed once the cache holds
+        more than `max_entries`, down to nine tenths of it.
+        Args:
+            cache_dir: directory where fitted distributions are stored
+            max_entries: maximum number of cached columns
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        # entries are counted once and then tracked, so saving does not list the whole cache every time
+        self._entry_count = None
+
+    @staticmethod
+    def get_key(
+            values: np.ndarray,
+            distribution_list: list[str],
+            method: str,
+            settings: dict | None = None,
+    ) -> str:
+        """
+        compute the cache key of a column
+        Args:
+            values: non-zero values of the column
+            distribution_list: list of allowed distributions
+            method: metric used to choose the best fitting distribution
+            settings: further estimator settings which change the result, if any
+        Returns: hex digest identifying the fit
+        """
+        digest = hashlib.sha256()
+        digest.update(f"format={CACHE_FORMAT_VERSION}".encode())
+        digest.update(json.dumps([list(distribution_list), str(method)]).encode())
+        if settings:
+            digest.update(json.dumps(settings, sort_keys=True).encode())
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        # entries are spread over subdirectories to keep directory listings short
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def load(self, keys: list[str]) -> dict[str, tuple[str, dict[str, float]]]:
+        """
+        load cached fits
+        Args:
+            keys: cache keys returned by `get_key`
+        Returns: mapping of the keys found in the cache to the distribution name and parameters
+        """
+        entries = {}
+        for key in keys:
+            path = self._path(key)
+            try:
+                with open(path) as file:
+                    entry = json.load(file)
+                os.utime(path)
+            except (OSError, ValueError):
+                continue
+            entries[key] = (entry["distribution"], entry["parameters"])
+        return entries
+
+    def save(self, entries: dict[str, tuple[str, dict[str, float]]]) -> None:
+        """
+        store fits in the cache and evict the least recently used entries above the size bound
+        Every entry is written to a temporary file first and then renamed, so concurrent readers
+        never see a partially written entry. The cache directory is only listed on the first save and
+        when the tracked number of entries exceeds the bound, entries added by other processes in the
+        meantime are counted then.
+        Args:
+            entries: mapping of cache keys to the distribution name and parameters
+        """
+        new_entries = 0
+        for key, (distribution, parameters) in entries.items():
+            path = self._path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            new_entries += not path.exists()
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as file:
+                json.dump({"distribution": distribution, "parameters": parameters}, file)
+            os.replace(tmp_path, path)
+
+        if self._entry_count is None:
+            self._entry_count = len(list(self.cache_dir.glob("*/*.json")))
+        else:
+            self._entry_count += new_entries
+        if self._entry_count > self.max_entries:
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        remove the least recently used entries if the cache holds more than `max_entries`
+        A tenth of the bound is freed at once, so the directory is not listed again for every new entry.
+        """
+        paths = list(self.cache_dir.glob("*/*.json"))
+        self._entry_count = len(paths)
+        if len(paths) <= self.max_entries:
+            return
+
+        modification_times = []
+        for path in paths:
+            try:
+                modification_times.append((path.stat().st_mtime_ns, path))
+            except OSError:
+                # removed by another process in the meantime
+                continue
+        modification_times.sort()
+
+        kept = self.max_entries - self.max_entries // 10
+        for _, path in modification_times[:len(modification_times) - kept]:
+            path.unlink(missing_ok=True)
+        self._entry_count = min(len(modification_times), kept)
@@ -1,8 +1,18 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
 import polars as pl
 from fitter import Fitter
 from tqdm import tqdm
 
+from src.data.data_models import SparsePeptides
+from src.modeling.batched_fitting import fit_distributions_batched
+from src.modeling.distribution_cache import DistributionFitCache
+
 
 class FitMethod(str, Enum):
     """
@@ -26,12 +36,79 @@ class Distributions(str, Enum):
     gaussian_kde = "gaussian_kde"
 
 
+def _fit_best_distribution(
+    values: np.ndarray,
+    distribution_list: list[str],
+    method: str,
+    max_workers: int = -1,
+) -> tuple[str, dict[str, float]]:
+    """
+    fit all candidate distributions to the values and return the best one
+    Args:
+        values: non-zero values of a column
+        distribution_list: list of allowed distributions
+        method: metric which should be used to choose the best fitting distribution
+        max_workers: number of joblib workers used by Fitter to fit the candidate distributions
+    Returns: name and fitted parameters of the best distribution
+    """
+    f = Fitter(values, distributions=distribution_list)
+    f.fit(max_workers=max_workers)
+
+    # Get the name of the best fitting distribution
+    best_distributions = f.get_best(method=method)
+    best_dist_name, params = next(iter(best_distributions.items()))
+    return best_dist_name, {name: float(value) for name, value in params.items()}
+
+
+def _estimate_column_chunk(
+    shared_memory_name: str,
+    offsets: np.ndarray,
+    distribution_list: list[str],
+    method: str,
+    batched: bool = False,
+) -> list[tuple[str, dict[str, float]]]:
+    """
+    worker task estimating the best distributions for a chunk of columns stored in shared memory
+    Args:
+        shared_memory_name: name of the shared memory block holding the concatenated column values
+        offsets: start of every column in the block followed by the end of the last column
+        distribution_list: list of allowed distributions
+        method: metric which should be used to choose the best fitting distribution
+        batched: if True, the columns of the chunk are fitted together by the batched engine
+    Returns: names and parameters of the best distributions in column order
+    """
+    shared_memory = SharedMemory(name=shared_memory_name)
+    try:
+        buffer = np.ndarray((offsets[-1],), dtype=np.float64, buffer=shared_memory.buf)
+        # values are copied so no view of the shared block outlives it
+        columns = [buffer[start:stop].copy() for start, stop in zip(offsets[:-1], offsets[1:])]
+        del buffer
+    finally:
+        shared_memory.close()
+
+    if batched:
+        return fit_distributions_batched(columns, distribution_list, method)
+    # the chunk is already fitted in its own process, so Fitter does not spawn further workers
+    return [
+        _fit_best_distribution(column, distribution_list, method, max_workers=1) for column in columns
+    ]
+
+
+
 class DistributionEstimator:
     def __init__(
         self,
         primary_key: str,
         distribution_list: list[str],
         method: str = FitMethod.sumsquare,
+        n_workers: int | None = 1,
+        column_chunk_size: int = 16,
+        batched: bool = False,
+        cache_dir: str | None = None,
+        cache_size: int = 100_000,
+        subsample_size: int | None = None,
+        subsample_rounds: int = 5,
+        subsample_seed: int = 0,
     ):
         """
         Used for estimating distributions to use in the gaussian copula for each peptide in the dataset.
@@ -40,11 +117,29 @@ class DistributionEstimator:
             peptides_to_model: dataframe containing the peptides for which optimal distributions should be
                                estimated
             method: metric which should be used to choose the best fitting distribution
+            n_workers: number of processes fitting columns in parallel, None uses all cores
+            column_chunk_size: number of columns sent to a worker process at once
+            batched: if True, normal and lognormal distributions are fitted to all columns at once
+            cache_dir: directory for caching fitted distributions, if None nothing is cached
+            cache_size: maximum number of columns kept in the cache
+            subsample_size: if set, the distribution of a column with more non-zero values is selected on
+                            stratified subsamples of this size and only the winner is fitted on all values
+            subsample_rounds: number of subsamples each distribution choice is voted on
+            subsample_seed: seed for drawing the subsamples
         """
         self.distribution_list = distribution_list
         self.method = method
         self.primary_key = primary_key
         self.distributions = None
+        self.parameters = None
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.column_chunk_size = column_chunk_size
+        self.batched = batched
+        self.cache = DistributionFitCache(cache_dir, cache_size) if cache_dir is not None else None
+        self.subsample_size = subsample_size
+        self.subsample_rounds = subsample_rounds
+        self.subsample_seed = subsample_seed
+        self.confidence = None
 
         # Check if the provided method is a valid FitMethod
         if method not in FitMethod.__members__.values():
@@ -59,21 +154,229 @@ class DistributionEstimator:
                     f"Invalid distribution '{distribution}'. Must be one of: {', '.join(Distributions.__members__.values())}."
                 )
 
-    def estimate(self, peptides_df) -> dict[str, str]:
+    def estimate(self, peptides_df: pl.DataFrame | SparsePeptides) -> dict[str, str]:
         """
         Estimate the best distributions for all peptides
+        With more than one worker, columns are fitted in parallel processes. The non-zero values of all
+        columns are copied into a single shared memory block once, and every task only receives the
+        offsets of its chunk of columns. Results are collected in column order, so they do not depend
+        on the number of workers.
+        The fitted parameters of the chosen distributions are kept in `parameters`, and the confidence in
+        choices made on subsamples in `confidence`. If a cache directory is
+        set, only columns whose values changed since an earlier run are fitted.
         Returns: dictionary mapping the peptide column name to the distribution name
         """
-        distributions = {}
-        peptides_df = peptides_df.fill_null(0)
-        for peptide in tqdm(peptides_df.columns, desc="Fitting Distributions"):
-            if peptide != self.primary_key:
-                distributions[peptide] = self.estimate_single_column_distribution(
-                    peptides_df[peptide],
-                )
+        if isinstance(peptides_df, SparsePeptides):
+            # non-zero values are read directly from the sparse columns
+            peptides = peptides_df.columns
+            columns = [peptides_df.column_values(peptide) for peptide in peptides]
+        else:
+            peptides_df = peptides_df.fill_null(0)
+            peptides = [peptide for peptide in peptides_df.columns if peptide != self.primary_key]
+            columns = [
+                peptides_df[peptide].filter(peptides_df[peptide] != 0).cast(pl.Float64).to_numpy()
+                for peptide in peptides
+            ]
+
+        best_distributions, confidence = self._estimate_columns(columns)
+
+        distributions = {peptide: name for peptide, (name, _) in zip(peptides, best_distributions)}
+        self.parameters = {peptide: params for peptide, (_, params) in zip(peptides, best_distributions)}
+        self.confidence = {
+            peptide: value for peptide, value in zip(peptides, confidence) if value is not None
+        }
         self.distributions = distributions
         return distributions
 
+    def _estimate_columns(
+            self,
+            columns: list[np.ndarray],
+    ) -> tuple[list[tuple[str, dict[str, float]]], list[float | None]]:
+        """
+        estimate the best distributions of the columns, reusing cached fits of unchanged columns
+        Args:
+            columns: non-zero values of every column
+        Returns: names and parameters of the best distributions in column order and the confidence in the
+                 choices made on subsamples (None for columns which were not subsampled or were cached)
+        """
+        if self.cache is None:
+            return self._fit_columns(columns)
+
+        # the engines may select different distributions for degenerate columns, and subsampled selections
+        # are cached separately from selections on all values
+        settings = {"batched": self.batched}
+        if self.subsample_size is not None:
+            settings.update(subsample_size=self.subsample_size, subsample_rounds=self.subsample_rounds,
+                            subsample_seed=self.subsample_seed)
+        keys = [
+            self.cache.get_key(column, self.distribution_list, self.method, settings) for column in columns
+        ]
+        cached = self.cache.load(keys)
+        if len(columns) > 1:
+            print(f"Loaded {len(cached)} of {len(columns)} fitted distributions from cache.")
+
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        results, missing_confidence = self._fit_columns([columns[i] for i in missing])
+        fitted = {keys[i]: result for i, result in zip(missing, results)}
+        if fitted:
+            self.cache.save(fitted)
+
+        confidence = [None] * len(columns)
+        for i, value in zip(missing, missing_confidence):
+            confidence[i] = value
+
+        cached.update(fitted)
+        return [cached[key] for key in keys], confidence
+
+    def _fit_columns(
+            self,
+            columns: list[np.ndarray],
+    ) -> tuple[list[tuple[str, dict[str, float]]], list[float | None]]:
+        """
+        estimate the best distributions of the columns, on subsamples of large columns if enabled
+        A large column is split into `subsample_size` quantile strata and one random value is drawn from
+        every stratum, `subsample_rounds` times. The distribution chosen most often is fitted on all values,
+        and the share of subsamples that chose it is reported as the confidence in the choice.
+        Args:
+            columns: non-zero values of every column
+        Returns: names and parameters of the best distributions in column order and the confidence in the
+                 choices made on subsamples (None for columns which were not subsampled)
+        """
+        confidence = [None] * len(columns)
+        if self.subsample_size is None:
+            return self._select_distributions(columns, self.distribution_list), confidence
+
+        results = [None] * len(columns)
+        large = [i for i, column in enumerate(columns) if len(column) > self.subsample_size]
+        small = [i for i, column in enumerate(columns) if len(column) <= self.subsample_size]
+
+        small_results = self._select_distributions([columns[i] for i in small], self.distribution_list)
+        for i, result in zip(small, small_results):
+            results[i] = result
+
+        # every large column is voted on several independent subsamples, fitted together in one call
+        subsamples = []
+        for i in large:
+            rng = self._subsample_rng(columns[i])
+            subsamples += [self._stratified_subsample(columns[i], rng) for _ in range(self.subsample_rounds)]
+        votes = self._select_distributions(subsamples, self.distribution_list)
+
+        winners = {}
+        for position, i in enumerate(large):
+            round_votes = votes[position * self.subsample_rounds:(position + 1) * self.subsample_rounds]
+            names = [name for name, _ in round_votes]
+            # ties are broken by the order of the distribution list
+            winner = max(self.distribution_list, key=names.count)
+            winners.setdefault(winner, []).append(i)
+            confidence[i] = names.count(winner) / self.subsample_rounds
+
+        # only the winning distribution is fitted on all values
+        for winner, indices in winners.items():
+            for i, result in zip(indices, self._select_distributions([columns[i] for i in indices], [winner])):
+                results[i] = result
+
+        if large:
+            values = np.array([confidence[i] for i in large])
+            print(
+                f"Selected distributions of {len(large)} columns on subsamples of {self.subsample_size} values, "
+                f"confidence: mean {values.mean():.2f}, min {values.min():.2f}, "
+                f"{int((values < 0.5).sum())} columns below 0.5."
+            )
+        return results, confidence
+
+    def _subsample_rng(self, values: np.ndarray) -> np.random.Generator:
+        """
+        random number generator of the subsamples of a column, seeded by `subsample_seed` and the values
+        The subsamples of a column do not depend on the other columns fitted with it, so cached selections
+        are the same as selections made again.
+        """
+        digest = hashlib.sha256(np.ascontiguousarray(values, dtype=np.float64).tobytes()).digest()
+        return np.random.default_rng([self.subsample_seed, *np.frombuffer(digest, dtype=np.uint32).tolist()])
+
+    def _stratified_subsample(self, values: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+        """
+        draw one random value from each of `subsample_size` equally sized quantile strata
+        Args:
+            values: non-zero values of a column
+            rng: random number generator used to pick the values within the strata
+        Returns: subsample with the same quantiles as the column
+        """
+        sorted_values = np.sort(values)
+        bounds = np.linspace(0, len(values), self.subsample_size + 1)
+        starts = bounds[:-1].astype(np.int64)
+        stops = np.maximum(bounds[1:].astype(np.int64), starts + 1)
+        return sorted_values[rng.integers(starts, stops)]
+
+    def _select_distributions(
+            self,
+            columns: list[np.ndarray],
+            distribution_list: list[str],
+    ) -> list[tuple[str, dict[str, float]]]:
+        """
+        estimate the best distributions of the columns with the configured engine
+        Args:
+            columns: non-zero values of every column
+            distribution_list: list of candidate distributions
+        Returns: names and parameters of the best distributions in column order
+        """
+        if not columns:
+            return []
+        if self.n_workers > 1 and len(columns) > 1:
+            return self._estimate_parallel(columns, distribution_list)
+        if self.batched:
+            return fit_distributions_batched(columns, distribution_list, self.method)
+        return [
+            _fit_best_distribution(column, distribution_list, self.method)
+            for column in tqdm(columns, desc="Fitting Distributions")
+        ]
+
+    def _estimate_parallel(
+            self,
+            columns: list[np.ndarray],
+            distribution_list: list[str],
+    ) -> list[tuple[str, dict[str, float]]]:
+        """
+        estimate the best distributions of the columns in a pool of worker processes
+        Args:
+            columns: non-zero values of every column
+            distribution_list: list of candidate distributions
+        Returns: names and parameters of the best distributions in column order
+        """
+        offsets = np.zeros(len(columns) + 1, dtype=np.int64)
+        np.cumsum([len(column) for column in columns], out=offsets[1:])
+
+        # size 0 is not allowed for shared memory
+        shared_memory = SharedMemory(create=True, size=max(int(offsets[-1]) * 8, 8))
+        try:
+            buffer = np.ndarray((offsets[-1],), dtype=np.float64, buffer=shared_memory.buf)
+            for column, start in zip(columns, offsets[:-1]):
+                buffer[start:start + len(column)] = column
+            del buffer
+
+            chunk_starts = range(0, len(columns), self.column_chunk_size)
+            results = [None] * len(chunk_starts)
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = {
+                    executor.submit(
+                        _estimate_column_chunk,
+                        shared_memory.name,
+                        offsets[start:start + self.column_chunk_size + 1],
+                        distribution_list,
+                        self.method,
+                        self.batched,
+                    ): i
+                    for i, start in enumerate(chunk_starts)
+                }
+                with tqdm(total=len(columns), desc="Fitting Distributions") as progress_bar:
+                    for future in as_completed(futures):
+                        results[futures[future]] = future.result()
+                        progress_bar.update(len(results[futures[future]]))
+        finally:
+            shared_memory.close()
+            shared_memory.unlink()
+
+        return [result for chunk in results for result in chunk]
+
     def estimate_single_column_distribution(self, column: pl.Series) -> str:
         """
         Estimate the optimal distribution for a single column
@@ -83,12 +386,6 @@ class DistributionEstimator:
         """
         column = column.filter(column != 0)
 
-        # Use the Fitter library to find the best distribution
-        f = Fitter(column.to_list(), distributions=self.distribution_list)
-        f.fit()
-
-        # Get the name of the best fitting distribution
-        best_distributions = f.get_best(method=self.method)
-        best_dist_name = list(best_distributions.keys())[0]
-
+        # fitted with the configured engine unless the column is cached
+        [(best_dist_name, _)], _ = self._estimate_columns([column.cast(pl.Float64).to_numpy()])
         return best_dist_name
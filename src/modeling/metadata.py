@@ -0,0 +1,50 @@
+import polars as pl
+import sdv.metadata
+
+
+def _sdtype(dtype: pl.DataType) -> str:
+    """sdtype of a column with a known polars type"""
+    if dtype.is_numeric():
+        return "numerical"
+    if dtype == pl.Boolean:
+        return "boolean"
+    if dtype.is_temporal():
+        return "datetime"
+    return "categorical"
+
+
+class SchemaMetadataBuilder:
+    def __init__(self, primary_key: str, peptide_schema: pl.Schema | dict[str, pl.DataType]):
+        """
+        builder of SDV metadata from the known schema of the modelled peptides
+        Types of the peptide columns are taken from their polars types once per dataset, only the few
+        clinical columns are detected by SDV for every group. The result is the same as detecting the
+        whole joined table and setting the peptides to numerical afterwards, without scanning the peptides.
+        Args:
+            primary_key: primary key column name
+            peptide_schema: polars schema of the modelled peptide columns, the primary key is skipped
+        """
+        self.primary_key = primary_key
+        self.peptide_columns = {
+            column: {"sdtype": "id" if column == primary_key else _sdtype(dtype)}
+            for column, dtype in peptide_schema.items()
+        }
+
+    def build(self, data: pl.DataFrame) -> sdv.metadata.SingleTableMetadata:
+        """
+        build the metadata of a table with clinical columns and the modelled peptides
+        Args:
+            data: dataframe containing joined peptides and clinical data
+
+        Returns: metadata object
+        """
+        clinical_columns = [column for column in data.columns if column not in self.peptide_columns]
+        clinical_metadata = sdv.metadata.SingleTableMetadata()
+        clinical_metadata.detect_from_dataframe(data.select(clinical_columns).to_pandas())
+
+        metadata = clinical_metadata.to_dict()
+        metadata["columns"] = {
+            column: metadata["columns"][column] if column in metadata["columns"] else self.peptide_columns[column]
+            for column in data.columns
+        }
+        return sdv.metadata.SingleTableMetadata.load_from_dict(metadata)
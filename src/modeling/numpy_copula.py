@@ -0,0 +1,583 @@
+import copy
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import sdv
+from copulas import get_instance
+from copulas.univariate import GaussianKDE, GaussianUnivariate
+from copulas.univariate.base import ScipyModel
+from rdt.transformers.utils import learn_rounding_digits
+from scipy.cluster import hierarchy
+from scipy.linalg import solve_triangular
+from scipy.spatial.distance import squareform
+from scipy.special import ndtr, ndtri
+
+from src.modeling.custom_copula_synthesizer import CustomGaussianCopulaSynthesizer
+from src.modeling.custom_univariate import QuantileTableUnivariate
+
+# same clipping of cumulative probabilities as copulas.multivariate.GaussianMultivariate
+EPSILON = np.finfo(np.float32).eps
+# factors of the copula of a block of ClusteredGaussianCopulaSynthesizer
+_BLOCK_FACTORS = ("shared", "cross", "own")
+
+
+class NumpyGaussianCopulaSynthesizer:
+    """
+    Lean gaussian copula engine working directly on NumPy arrays.
+    It can be passed as `sdv_synthesizer` to `Synthesizer` instead of CustomGaussianCopulaSynthesizer and
+    produces samples with the same columns and dtypes. Marginals use the same univariate distributions as
+    the SDV backend, the dependence is a correlation matrix of normal scores and samples are drawn in
+    blocks through its Cholesky factor.
+    """
+
+    _DISTRIBUTIONS = CustomGaussianCopulaSynthesizer._DISTRIBUTIONS
+    # large fitted arrays, `Synthesizer.save` stores them as memory mappable .npy files
+    _ARRAY_ATTRIBUTES = ("_cholesky",)
+
+    def __init__(
+            self,
+            metadata: sdv.metadata.SingleTableMetadata,
+            numerical_distributions: dict[str, str] | None = None,
+            default_distribution: str = "beta",
+            fitted_parameters: dict[str, dict[str, float]] | None = None,
+            enforce_min_max_values: bool = True,
+            enforce_rounding: bool = True,
+            sampling_dtype: str = "float64",
+            block_size: int = 10_000,
+            quantile_table_tolerance: float | None = None,
+    ):
+        """
+        Args:
+            metadata: metadata describing the table, ids are generated and all other columns are modelled
+            numerical_distributions: distribution name for numerical columns, keyed by column name
+            default_distribution: distribution of numerical columns missing from `numerical_distributions`
+            fitted_parameters: already fitted parameters of the marginal distributions, keyed by column name
+            enforce_min_max_values: if True, sampled values are clipped to the range of the real values
+            enforce_rounding: if True, sampled values are rounded to the decimals of the real values
+            sampling_dtype: dtype of the correlated normal samples, float32 halves memory and matmul time
+            block_size: number of rows sampled at once
+            quantile_table_tolerance: if given, fitted marginals are sampled by interpolation in quantile
+                                      tables with at most this error in probability, see `QuantileTableUnivariate`
+        """
+        self.metadata = metadata
+        self.numerical_distributions = numerical_distributions or {}
+        self.default_distribution = default_distribution
+        self.fitted_parameters = fitted_parameters or {}
+        self.enforce_min_max_values = enforce_min_max_values
+        self.enforce_rounding = enforce_rounding
+        self.sampling_dtype = np.dtype(sampling_dtype)
+        self.block_size = block_size
+        self.quantile_table_tolerance = quantile_table_tolerance
+
+        self.columns = None
+        self.modelled_columns = None
+        self.marginals = None
+        self.correlation = None
+        self._cholesky = None
+        # seeded from the global state, which Synthesizer seeds for reproducible experiments
+        self._rng = np.random.default_rng(np.random.randint(0, 2 ** 31 - 1))
+
+    def __getstate__(self) -> dict[str, Any]:
+        # sampling only needs the factor of the correlation matrix, so pickled models leave the matrix out
+        state = self.__dict__.copy()
+        state["correlation"] = None
+        return state
+
+    def _detach_arrays(self) -> tuple["NumpyGaussianCopulaSynthesizer", dict[str, np.ndarray]]:
+        """
+        split the large fitted arrays off the synthesizer, `Synthesizer.save` stores them as .npy files
+        Returns: copy of the synthesizer without the arrays and the arrays keyed by name
+        """
+        model = copy.copy(self)
+        arrays = {}
+        for attribute in self._ARRAY_ATTRIBUTES:
+            if getattr(model, attribute) is not None:
+                arrays[attribute] = getattr(model, attribute)
+                setattr(model, attribute, None)
+        return model, arrays
+
+    def _attach_arrays(self, arrays: dict[str, np.ndarray]) -> None:
+        """set the arrays returned by `_detach_arrays`, e.g. memory mapped from .npy files"""
+        for attribute, array in arrays.items():
+            setattr(self, attribute, array)
+
+    def set_random_state(self, seed_sequence: np.random.SeedSequence) -> None:
+        """
+        draw the random numbers of the following samples from a stream created from `seed_sequence`
+        Args:
+            seed_sequence: seed of the samples
+        """
+        self._rng = np.random.default_rng(seed_sequence)
+
+    def fit(self, data: pd.DataFrame) -> None:
+        """
+        fit the marginals of all columns and the correlation of their normal scores
+        Args:
+            data: real data with the columns described by the metadata
+        """
+        self.columns = {column: data[column].dtype for column in data.columns}
+        self.modelled_columns = [
+            column for column in data.columns
+            if self.metadata.columns.get(column, {}).get("sdtype") != "id"
+        ]
+        self.marginals = {}
+        scores = np.empty((len(data), len(self.modelled_columns)))
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", module="scipy")
+            for i, column in enumerate(self.modelled_columns):
+                self.marginals[column], scores[:, i] = self._fit_marginal(column, data[column])
+
+        self._fit_dependence(scores)
+
+    def sample(self, num_rows: int, batch_size: int | None = None) -> pd.DataFrame:
+        """
+        sample a synthetic dataset
+        Args:
+            num_rows: number of synthetic rows
+            batch_size: number of rows sampled at once, `block_size` is used if None
+
+        Returns: dataframe with the same columns and dtypes as the real data
+        """
+        block_size = batch_size or self.block_size
+        uniforms = {column: np.empty(num_rows) for column in self.modelled_columns}
+        for start in range(0, num_rows, block_size):
+            normal = self._sample_normal(min(block_size, num_rows - start))
+            block = ndtr(normal.astype(np.float64, copy=False))
+            for i, column in enumerate(self.modelled_columns):
+                uniforms[column][start:start + len(block)] = block[:, i]
+
+        sampled = {
+            column: self._reverse_marginal(self.marginals[column], uniforms.pop(column))
+            for column in self.modelled_columns
+        }
+
+        output = {}
+        for column, dtype in self.columns.items():
+            if column in sampled:
+                output[column] = sampled[column]
+            else:
+                # ids are generated, they are replaced when the groups are merged anyway
+                output[column] = np.arange(num_rows).astype(dtype if dtype != object else str)
+        return pd.DataFrame(output)
+
+    def _fit_marginal(self, column: str, values: pd.Series) -> tuple[dict[str, Any], np.ndarray]:
+        """
+        fit the marginal distribution of a single column and compute its normal scores
+        Numerical columns are fitted with their univariate distribution on the non-null values, nulls get
+        a normal score of 0. Other columns are encoded as categories, each category covering an interval of
+        [0, 1] as wide as its frequency.
+        Args:
+            column: column name
+            values: real values of the column
+
+        Returns: marginal description and normal scores of the values
+        """
+        sdtype = self.metadata.columns.get(column, {}).get("sdtype")
+        numeric = pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values)
+        if sdtype not in ("numerical", "unknown", None) or not numeric:
+            return self._fit_categorical(values)
+
+        array = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        nulls = np.isnan(array)
+        real = array[~nulls]
+        if len(real) == 0:
+            return {"type": "empty", "dtype": values.dtype}, np.zeros(len(array))
+
+        distribution = self.numerical_distributions.get(column, self.default_distribution)
+        univariate = get_instance(self._DISTRIBUTIONS.get(distribution, distribution))
+        params = self.fitted_parameters.get(column)
+        if params and isinstance(univariate, ScipyModel) and not isinstance(univariate, GaussianKDE):
+            univariate._set_params(params)
+            univariate.fitted = True
+        else:
+            try:
+                univariate.fit(real)
+            except BaseException:
+                # same fallback as GaussianMultivariate.fit
+                univariate = GaussianUnivariate()
+                univariate.fit(real)
+
+        scores = np.zeros(len(array))
+        with np.errstate(all="ignore"):
+            cdf = np.asarray(univariate.cumulative_distribution(real), dtype=np.float64)
+        scores[~nulls] = ndtri(np.clip(np.nan_to_num(cdf, nan=0.5), EPSILON, 1 - EPSILON))
+        if self.quantile_table_tolerance is not None:
+            # the scores are computed with the exact marginal, only sampling uses the table
+            univariate = QuantileTableUnivariate(univariate, self.quantile_table_tolerance)
+
+        return {
+            "type": "numerical",
+            "univariate": univariate,
+            "dtype": values.dtype,
+            "null_rate": nulls.mean(),
+            "min": real.min(),
+            "max": real.max(),
+            "digits": learn_rounding_digits(pd.Series(real)),
+        }, scores
+
+    def _fit_categorical(self, values: pd.Series) -> tuple[dict[str, Any], np.ndarray]:
+        """
+        encode a column as categories covering intervals of [0, 1], like the SDV UniformEncoder
+        Args:
+            values: real values of the column
+
+        Returns: marginal description and normal scores drawn uniformly within the category intervals
+        """
+        codes, categories = pd.factorize(values, use_na_sentinel=False)
+        frequencies = np.bincount(codes, minlength=len(categories)) / len(codes)
+        upper = np.cumsum(frequencies)
+        upper[-1] = 1.0
+        lower = upper - frequencies
+
+        uniform = lower[codes] + self._rng.random(len(codes)) * frequencies[codes]
+        scores = ndtri(np.clip(uniform, EPSILON, 1 - EPSILON))
+        return {
+            "type": "categorical",
+            "categories": np.asarray(categories, dtype=object),
+            "upper": upper,
+            "dtype": values.dtype,
+        }, scores
+
+    def _reverse_marginal(self, marginal: dict[str, Any], uniform: np.ndarray) -> np.ndarray:
+        """
+        map uniform samples back to values of a column
+        Args:
+            marginal: marginal description returned by `_fit_marginal`
+            uniform: samples of the column in [0, 1]
+
+        Returns: sampled values of the column
+        """
+        if marginal["type"] == "empty":
+            return np.full(len(uniform), np.nan)
+
+        if marginal["type"] == "categorical":
+            codes = np.minimum(np.searchsorted(marginal["upper"], uniform, side="right"), len(marginal["upper"]) - 1)
+            values = pd.Series(marginal["categories"][codes])
+            try:
+                return values.astype(marginal["dtype"]).to_numpy()
+            except (TypeError, ValueError):
+                # e.g. an integer column with nulls
+                return values.infer_objects().to_numpy()
+
+        uniform = np.clip(uniform, EPSILON, 1 - EPSILON)
+        values = np.asarray(marginal["univariate"].percent_point(uniform), dtype=np.float64)
+        if self.enforce_min_max_values:
+            values = np.clip(values, marginal["min"], marginal["max"])
+        if self.enforce_rounding and marginal["digits"] is not None:
+            values = np.round(values, marginal["digits"])
+
+        nulls = self._rng.random(len(values)) < marginal["null_rate"]
+        if nulls.any():
+            values[nulls] = np.nan
+            return values
+        if pd.api.types.is_integer_dtype(marginal["dtype"]):
+            return values.astype(marginal["dtype"])
+        return values
+
+    def _fit_dependence(self, scores: np.ndarray) -> None:
+        """
+        fit the dependence between the columns from their normal scores
+        Args:
+            scores: normal scores of shape (rows, columns)
+        """
+        self.correlation = self._fit_correlation(scores)
+        self._cholesky = self._factorize(self.correlation)
+
+    @staticmethod
+    def _standardize(scores: np.ndarray) -> np.ndarray:
+        """
+        center and scale every column of the normal scores, constant columns become zero
+        Args:
+            scores: normal scores of shape (rows, columns)
+
+        Returns: standardized scores
+        """
+        centered = scores - scores.mean(axis=0)
+        std = centered.std(axis=0)
+        return np.divide(centered, std, out=np.zeros_like(centered), where=std > 0)
+
+    def _fit_correlation(self, scores: np.ndarray) -> np.ndarray:
+        """
+        correlation matrix of the normal scores, constant columns are uncorrelated with all others
+        Args:
+            scores: normal scores of shape (rows, columns)
+
+        Returns: correlation matrix
+        """
+        standardized = self._standardize(scores)
+        correlation = standardized.T @ standardized / len(scores)
+        np.fill_diagonal(correlation, 1.0)
+        return correlation
+
+    @staticmethod
+    def _factorize(correlation: np.ndarray) -> np.ndarray:
+        """
+        Cholesky factor of the correlation matrix
+        A rank deficient matrix, e.g. with more columns than rows, is first projected to the nearest
+        positive definite correlation matrix by clipping its eigenvalues.
+        Args:
+            correlation: correlation matrix
+
+        Returns: lower triangular factor
+        """
+        try:
+            return np.linalg.cholesky(correlation)
+        except np.linalg.LinAlgError:
+            eigenvalues, eigenvectors = np.linalg.eigh(correlation)
+            eigenvalues = np.maximum(eigenvalues, 1e-8)
+            repaired = (eigenvectors * eigenvalues) @ eigenvectors.T
+            scale = 1 / np.sqrt(np.diag(repaired))
+            return np.linalg.cholesky(repaired * scale[:, None] * scale[None, :])
+
+    def _sample_normal(self, num_rows: int) -> np.ndarray:
+        """
+        sample correlated standard normal rows
+        Args:
+            num_rows: number of rows
+
+        Returns: samples of shape (rows, modelled columns) in `sampling_dtype`
+        """
+        cholesky = self._cholesky.astype(self.sampling_dtype, copy=False)
+        independent = self._rng.standard_normal((num_rows, cholesky.shape[0]), dtype=self.sampling_dtype)
+        return independent @ cholesky.T
+
+
+class FactorGaussianCopulaSynthesizer(NumpyGaussianCopulaSynthesizer):
+    """
+    Gaussian copula with a low rank plus diagonal (factor) correlation structure.
+    The correlation of the normal scores is approximated by L @ L.T + diag(d) with `n_factors` loadings per
+    column, estimated from a truncated SVD of the standardized scores. The dense correlation matrix is never
+    formed, so fitting needs O(n * p * k) time and O(p * k) extra memory and sampling is O(n * p * k) for
+    n rows, p columns and k factors. This suits tables with many more peptides than patients, where the
+    full correlation matrix is rank deficient anyway.
+    """
+
+    _ARRAY_ATTRIBUTES = ("loadings", "uniqueness")
+
+    def __init__(self, metadata: sdv.metadata.SingleTableMetadata, n_factors: int = 10, **kwargs):
+        """
+        Args:
+            metadata: metadata describing the table
+            n_factors: number of common factors
+            **kwargs: extra kwargs for NumpyGaussianCopulaSynthesizer
+        """
+        super().__init__(metadata, **kwargs)
+        self.n_factors = n_factors
+        self.loadings = None
+        self.uniqueness = None
+
+    def _fit_dependence(self, scores: np.ndarray) -> None:
+        """
+        estimate factor loadings and the remaining variance of every column
+        Args:
+            scores: normal scores of shape (rows, columns)
+        """
+        standardized = self._standardize(scores) / np.sqrt(len(scores))
+        n_factors = min(self.n_factors, *standardized.shape)
+        singular_values, right_vectors = self._truncated_svd(standardized, n_factors)
+
+        loadings = right_vectors.T * singular_values
+        # every column has unit variance, so the common part can explain at most all of it
+        communality = np.sum(loadings ** 2, axis=1)
+        too_large = communality > 1 - EPSILON
+        loadings[too_large] *= np.sqrt((1 - EPSILON) / communality[too_large])[:, None]
+
+        self.loadings = loadings
+        self.uniqueness = 1 - np.sum(loadings ** 2, axis=1)
+
+    def _truncated_svd(self, matrix: np.ndarray, rank: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        leading singular values and right singular vectors with a randomized range finder
+        Args:
+            matrix: matrix of shape (rows, columns)
+            rank: number of singular values
+
+        Returns: singular values and right singular vectors of shape (rank, columns)
+        """
+        oversampled_rank = min(rank + 10, *matrix.shape)
+        sketch = matrix @ self._rng.standard_normal((matrix.shape[1], oversampled_rank))
+        basis, _ = np.linalg.qr(sketch)
+        # power iterations sharpen the decay of the spectrum
+        for _ in range(2):
+            basis, _ = np.linalg.qr(matrix.T @ basis)
+            basis, _ = np.linalg.qr(matrix @ basis)
+
+        _, singular_values, right_vectors = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+        return singular_values[:rank], right_vectors[:rank]
+
+    def _sample_normal(self, num_rows: int) -> np.ndarray:
+        """
+        sample correlated standard normal rows from the common factors and independent noise
+        Args:
+            num_rows: number of rows
+
+        Returns: samples of shape (rows, modelled columns) in `sampling_dtype`
+        """
+        loadings = self.loadings.astype(self.sampling_dtype, copy=False)
+        factors = self._rng.standard_normal((num_rows, loadings.shape[1]), dtype=self.sampling_dtype)
+        noise = self._rng.standard_normal((num_rows, loadings.shape[0]), dtype=self.sampling_dtype)
+        noise *= np.sqrt(self.uniqueness).astype(self.sampling_dtype)
+        noise += factors @ loadings.T
+        return noise
+
+
+class ClusteredGaussianCopulaSynthesizer(NumpyGaussianCopulaSynthesizer):
+    """
+    Gaussian copula with a block diagonal peptide correlation linked through the clinical columns.
+    Peptides are grouped into blocks of at most `max_block_size` columns by hierarchical clustering of their
+    normal score correlation. The clinical columns get one joint copula, every peptide block gets its own
+    copula together with the clinical columns it correlates with. Peptides of a block are sampled
+    conditionally on these clinical columns, so blocks are independent of each other given the clinical
+    data. Instead of factorizing one p x p matrix, many small blocks are factorized, and blocks are fitted
+    and sampled concurrently by `n_workers` threads.
+    """
+
+    def __init__(
+            self,
+            metadata: sdv.metadata.SingleTableMetadata,
+            peptide_columns: list[str] | None = None,
+            max_block_size: int = 500,
+            link_threshold: float = 0.1,
+            n_workers: int = 1,
+            **kwargs,
+    ):
+        """
+        Args:
+            metadata: metadata describing the table
+            peptide_columns: columns which are clustered into blocks, all other modelled columns are clinical
+                             columns shared by the blocks. If None, all modelled columns are clustered.
+            max_block_size: maximum number of peptides in a block
+            link_threshold: minimum absolute correlation between a clinical column and any peptide of a block
+                            for the clinical column to be part of the copula of the block
+            n_workers: number of threads fitting and sampling blocks
+            **kwargs: extra kwargs for NumpyGaussianCopulaSynthesizer
+        """
+        super().__init__(metadata, **kwargs)
+        self.peptide_columns = peptide_columns
+        self.max_block_size = max_block_size
+        self.link_threshold = link_threshold
+        self.n_workers = n_workers
+        self.shared_indices = None
+        self.blocks = None
+
+    def _fit_dependence(self, scores: np.ndarray) -> None:
+        """
+        cluster the peptides into blocks and fit the copula of the clinical columns and of every block
+        Args:
+            scores: normal scores of shape (rows, columns)
+        """
+        if self.peptide_columns is None:
+            clustered = np.ones(len(self.modelled_columns), dtype=bool)
+        else:
+            clustered = np.isin(self.modelled_columns, self.peptide_columns)
+        shared_indices = np.flatnonzero(~clustered)
+        peptide_indices = np.flatnonzero(clustered)
+
+        standardized = self._standardize(scores)
+        shared_scores = standardized[:, shared_indices]
+        self.shared_indices = shared_indices
+        self._cholesky = self._factorize(self._fit_correlation(scores[:, shared_indices]))
+
+        def fit_block(block):
+            peptide_scores = standardized[:, block]
+            # clinical columns correlated with any peptide of the block
+            cross_correlation = shared_scores.T @ peptide_scores / len(scores)
+            linked = np.flatnonzero(np.abs(cross_correlation).max(axis=1, initial=0) >= self.link_threshold)
+
+            correlation = self._fit_correlation(np.hstack([shared_scores[:, linked], peptide_scores]))
+            cholesky = self._factorize(correlation)
+            return {
+                "columns": block,
+                "linked": linked,
+                # the joint factor is [[shared, 0], [cross, own]] with the linked clinical columns first
+                "shared": cholesky[:len(linked), :len(linked)],
+                "cross": cholesky[len(linked):, :len(linked)],
+                "own": cholesky[len(linked):, len(linked):],
+            }
+
+        blocks = self._cluster(standardized[:, peptide_indices])
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            self.blocks = list(executor.map(fit_block, (peptide_indices[block] for block in blocks)))
+        print(
+            f"Clustered {len(peptide_indices)} columns into {len(self.blocks)} blocks, "
+            f"largest block has {max((len(block) for block in blocks), default=0)} columns."
+        )
+
+    def _detach_arrays(self) -> tuple["ClusteredGaussianCopulaSynthesizer", dict[str, np.ndarray]]:
+        model, arrays = super()._detach_arrays()
+        if model.blocks is not None:
+            model.blocks = []
+            for i, block in enumerate(self.blocks):
+                model.blocks.append(dict(block))
+                for key in _BLOCK_FACTORS:
+                    arrays[f"blocks.{i}.{key}"] = block[key]
+                    model.blocks[i][key] = None
+        return model, arrays
+
+    def _attach_arrays(self, arrays: dict[str, np.ndarray]) -> None:
+        for name, array in arrays.items():
+            if name.startswith("blocks."):
+                _, i, key = name.split(".")
+                self.blocks[int(i)][key] = array
+            else:
+                setattr(self, name, array)
+
+    def _cluster(self, standardized: np.ndarray) -> list[np.ndarray]:
+        """
+        split columns into blocks of at most `max_block_size` columns by average linkage clustering
+        The distance between two columns is one minus their absolute correlation, the cluster tree is cut
+        at the highest nodes which are small enough.
+        Args:
+            standardized: standardized normal scores of the clustered columns
+
+        Returns: column indices of every block
+        """
+        if standardized.shape[1] <= self.max_block_size:
+            return [np.arange(standardized.shape[1])]
+
+        distance = 1 - np.abs(standardized.T @ standardized / len(standardized))
+        np.fill_diagonal(distance, 0)
+        tree = hierarchy.to_tree(hierarchy.linkage(squareform(np.clip(distance, 0, None), checks=False), "average"))
+
+        blocks = []
+        nodes = [tree]
+        while nodes:
+            node = nodes.pop()
+            if node.get_count() <= self.max_block_size:
+                blocks.append(np.sort(node.pre_order()))
+            else:
+                nodes.extend([node.get_right(), node.get_left()])
+        return blocks
+
+    def _sample_normal(self, num_rows: int) -> np.ndarray:
+        """
+        sample the clinical columns and then every peptide block conditionally on them
+        Args:
+            num_rows: number of rows
+
+        Returns: samples of shape (rows, modelled columns) in `sampling_dtype`
+        """
+        samples = np.empty((num_rows, len(self.modelled_columns)), dtype=self.sampling_dtype)
+        shared_cholesky = self._cholesky.astype(self.sampling_dtype, copy=False)
+        shared = self._rng.standard_normal((num_rows, len(self.shared_indices)), dtype=self.sampling_dtype)
+        samples[:, self.shared_indices] = shared @ shared_cholesky.T
+        shared = samples[:, self.shared_indices]
+
+        # every block draws from its own generator, so samples do not depend on the order of the threads
+        seeds = self._rng.integers(0, 2 ** 63, size=len(self.blocks))
+
+        def sample_block(block, seed):
+            rng = np.random.default_rng(seed)
+            # independent normals of the linked clinical columns which produced the sampled values
+            linked = solve_triangular(block["shared"], shared[:, block["linked"]].T.astype(np.float64), lower=True)
+            own = rng.standard_normal((num_rows, len(block["columns"])), dtype=self.sampling_dtype)
+            own = own @ block["own"].astype(self.sampling_dtype, copy=False).T
+            own += (block["cross"] @ linked).T.astype(self.sampling_dtype, copy=False)
+            samples[:, block["columns"]] = own
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            list(executor.map(sample_block, self.blocks, seeds))
+        return samples
@@ -1,4 +1,10 @@
-from typing import Type, Any
+import copy
+import json
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator, Type
 
 import pandas as pd
 import polars as pl
@@ -8,7 +14,51 @@ import sdv.single_table.base
 import numpy as np
 import torch
 
+from src.modeling.constraints import ConstraintLayer
 from src.modeling.custom_copula_synthesizer import CustomGaussianCopulaSynthesizer
+from src.modeling.metadata import SchemaMetadataBuilder
+from src.modeling.numpy_copula import (
+    ClusteredGaussianCopulaSynthesizer,
+    FactorGaussianCopulaSynthesizer,
+    NumpyGaussianCopulaSynthesizer,
+)
+
+# copula engines which can be selected in the configuration
+SYNTHESIZER_ENGINES = {
+    "sdv": CustomGaussianCopulaSynthesizer,
+    "numpy": NumpyGaussianCopulaSynthesizer,
+    "factor": FactorGaussianCopulaSynthesizer,
+    "clustered": ClusteredGaussianCopulaSynthesizer,
+}
+
+
+# fitted model and constraint layer deserialized once in every sampling worker process
+_SHARD_MODEL = None
+
+
+def _load_shard_model(serialized_model: bytes) -> None:
+    """deserialize the fitted model and constraint layer in a sampling worker process"""
+    global _SHARD_MODEL
+    _SHARD_MODEL = pickle.loads(serialized_model)
+
+
+def _sample_shard(
+        num_rows: int,
+        seed_sequence: np.random.SeedSequence,
+        batch_size: int | None = None,
+) -> pd.DataFrame:
+    """
+    sample a shard with the model of the worker process
+    Args:
+        num_rows: number of rows in the shard
+        seed_sequence: seed of the shard, its samples do not depend on shards sampled before
+        batch_size: generate data in batches of this size
+
+    Returns: dataframe containing the shard
+    """
+    model, constraint_layer = _SHARD_MODEL
+    model.set_random_state(seed_sequence)
+    return constraint_layer.reverse_transform(model.sample(num_rows, batch_size=batch_size))
 
 
 class Synthesizer:
@@ -19,9 +69,11 @@ class Synthesizer:
             peptides_to_model: list,
             constraints: list[dict[str, Any]],
             sdv_synthesizer: Type[
-                sdv.single_table.base.BaseSingleTableSynthesizer
+                sdv.single_table.base.BaseSingleTableSynthesizer | NumpyGaussianCopulaSynthesizer
             ] = CustomGaussianCopulaSynthesizer,
             random_seed: int | None = None,
+            fitted_parameters: dict[str, dict[str, float]] | None = None,
+            metadata_builder: SchemaMetadataBuilder | None = None,
             *args,
             **kwargs,
     ):
@@ -31,9 +83,16 @@ class Synthesizer:
             original_data: dataframe containing the original real patient data
             primary_key: primary key column name
             peptides_to_model: peptides which should be modeled using the copula approach
-            sdv_synthesizer: class which should be instantiated for the synthetic data model
+            sdv_synthesizer: class which should be instantiated for the synthetic data model, an SDV synthesizer
+                             or one of the engines in `SYNTHESIZER_ENGINES`
             random_seed: seed for random number generator to be able to reproduce experiments
-            constraints: deterministic constraints for columns
+            constraints: deterministic constraints for columns, enforced by the vectorized transforms of
+                         `ConstraintLayer` instead of the constraints of the SDV synthesizer
+            fitted_parameters: marginal parameters from the distribution estimation, keyed by column name.
+                               They are reused by the copula instead of fitting these marginals again.
+                               Columns transformed by constraints are fitted anyway.
+            metadata_builder: builder of the metadata shared by the groups of a dataset, if None it is built
+                              from the schema of `peptides_to_model`
             *args: extra args for sdv_synthesizer
             **kwargs: extra kwargs for sdv_synthesizer
         """
@@ -42,17 +101,36 @@ class Synthesizer:
         self.peptides_to_model = peptides_to_model
         self.random_seed = random_seed
         self.constraints = constraints
+        self.constraint_layer = ConstraintLayer(constraints)
+        self._serialized_model = None
 
         if self.random_seed is not None:
             np.random.seed(self.random_seed)
             torch.manual_seed(self.random_seed)
 
-        self.metadata = self._get_metadata(
-            self.original_data.to_pandas(), self.peptides_to_model
-        )
+        if metadata_builder is None:
+            metadata_builder = SchemaMetadataBuilder(
+                self.primary_key, self.original_data.select(self.peptides_to_model).collect_schema()
+            )
+        # only the clinical columns are detected, the real data is converted to pandas once in `fit`
+        self.metadata = metadata_builder.build(self.original_data)
+
+        # marginals estimated on the real values do not describe the transformed constrained columns
+        transformed_columns = set(self.constraint_layer.transformed_columns)
+        if fitted_parameters:
+            kwargs["fitted_parameters"] = {
+                column: params
+                for column, params in fitted_parameters.items()
+                if column not in transformed_columns
+            }
+        if kwargs.get("numerical_distributions"):
+            kwargs["numerical_distributions"] = {
+                column: distribution
+                for column, distribution in kwargs["numerical_distributions"].items()
+                if column not in transformed_columns
+            }
 
         self.sdv_synthesizer = sdv_synthesizer(metadata=self.metadata, *args, **kwargs)
-        self._load_constraints()
 
     def sample(
             self,
@@ -67,38 +145,133 @@ class Synthesizer:
 
         Returns: dataframe containing the synthetic dataset
         """
-        return self.sdv_synthesizer.sample(num_samples, batch_size=batch_size)
+        return self.constraint_layer.reverse_transform(
+            self.sdv_synthesizer.sample(num_samples, batch_size=batch_size)
+        )
 
-    def fit(self):
-        # Fit the model to the data
-        self.sdv_synthesizer.fit(self.original_data.to_pandas())
-        print("Model fitted.")
+    def sample_batches(
+            self,
+            num_samples: int,
+            batch_size: int | None = None,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        sample a synthetic dataset batch by batch, only one batch is held in memory at a time
+        Args:
+            num_samples: number of synthetic patients
+            batch_size: number of synthetic patients in every batch, all at once if None
+
+        Returns: iterator over dataframes containing the batches of the synthetic dataset
+        """
+        batch_size = batch_size or num_samples
+        for start in range(0, num_samples, batch_size):
+            yield self.sample(min(batch_size, num_samples - start), batch_size=batch_size)
 
-    def _get_metadata(
-            self, dataset: pl.DataFrame, peptide_columns: list[str]
-    ) -> sdv.metadata.SingleTableMetadata:
+    def sample_shards(
+            self,
+            num_samples: int,
+            shard_size: int,
+            n_workers: int = 1,
+            batch_size: int | None = None,
+    ) -> Iterator[pd.DataFrame]:
         """
-        generate metadata for all columns so the synthesizer knows types of each variable
+        sample a synthetic dataset in shards of `shard_size` rows with `n_workers` processes
+        The fitted model is serialized once and loaded once by every worker. Every shard draws from its own
+        stream spawned from `random_seed`, so the output is identical for any number of workers. Shards are
+        yielded in order, and at most two shards per worker are sampled ahead of the consumer.
         Args:
-            dataset: dataframe containing joined peptides and clinical data
-            peptide_columns: list of peptide columns
-        Returns: metadata object
+            num_samples: number of synthetic patients
+            shard_size: number of synthetic patients in every shard
+            n_workers: number of worker processes, shards are sampled in this process if 1
+            batch_size: generate data in batches of this size within a shard
+
+        Returns: iterator over dataframes containing the shards of the synthetic dataset
         """
-        metadata = sdv.metadata.SingleTableMetadata()
-        metadata.detect_from_dataframe(dataset)
+        if self._serialized_model is None:
+            self._serialized_model = pickle.dumps((self.sdv_synthesizer, self.constraint_layer))
 
-        for column in peptide_columns:
-            if column == self.primary_key:
-                metadata.update_column(column, sdtype="id")
-            else:
-                metadata.update_column(column, sdtype="numerical")
+        shard_rows = [min(shard_size, num_samples - start) for start in range(0, num_samples, shard_size)]
+        seeds = np.random.SeedSequence(self.random_seed).spawn(len(shard_rows))
 
-        return metadata
+        if n_workers == 1:
+            # the model is deserialized here as well, so sampling does not change the state of the fitted model
+            _load_shard_model(self._serialized_model)
+            for rows, seed in zip(shard_rows, seeds):
+                yield _sample_shard(rows, seed, batch_size)
+            return
 
-    def _load_constraints(self):
+        with ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_load_shard_model, initargs=(self._serialized_model,)
+        ) as executor:
+            pending = deque()
+            for rows, seed in zip(shard_rows, seeds):
+                pending.append(executor.submit(_sample_shard, rows, seed, batch_size))
+                if len(pending) >= 2 * n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def save(self, path: str | Path) -> None:
         """
-        add constraints which enforce known rules data should adhere to
-        i.e. diastolic blood pressure is always lower than systolic blood pressure
+        save the fitted synthesizer to a directory, the real data is not saved
+        Large fitted arrays, i.e. the correlation matrix of the SDV engine and the factors of the NumPy
+        engines, are stored as .npy files which are memory mapped on loading. Everything else, i.e. the marginal
+        parameters, the fitted constraints and the metadata, is pickled. `manifest.json` describes the
+        artifact in a readable form.
+        Args:
+            path: directory of the artifact
         """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        model, detached = self.sdv_synthesizer._detach_arrays()
+        arrays = {}
+        for name, array in detached.items():
+            arrays[name] = f"{name.lstrip('_')}.npy"
+            np.save(path / arrays[name], array)
+
+        synthesizer = copy.copy(self)
+        synthesizer.original_data = None
+        synthesizer.sdv_synthesizer = model
+        synthesizer._serialized_model = None
+        with open(path / "synthesizer.pkl", "wb") as file:
+            pickle.dump(synthesizer, file)
+
+        manifest = {
+            "engine": type(self.sdv_synthesizer).__name__,
+            "primary_key": self.primary_key,
+            "random_seed": self.random_seed,
+            "constraints": self.constraints,
+            "metadata": self.metadata.to_dict(),
+            "arrays": arrays,
+        }
+        with open(path / "manifest.json", "w") as file:
+            json.dump(manifest, file, indent=2, default=str)
 
-        self.sdv_synthesizer.add_constraints(constraints=self.constraints)
+    @classmethod
+    def load(cls, path: str | Path) -> "Synthesizer":
+        """
+        load a fitted synthesizer saved with `save`, it can be sampled but not fitted again
+        Args:
+            path: directory of the artifact
+
+        Returns: fitted synthesizer
+        """
+        path = Path(path)
+        with open(path / "synthesizer.pkl", "rb") as file:
+            synthesizer = pickle.load(file)
+        with open(path / "manifest.json") as file:
+            manifest = json.load(file)
+        synthesizer.sdv_synthesizer._attach_arrays(
+            {name: np.load(path / file_name, mmap_mode="r") for name, file_name in manifest["arrays"].items()}
+        )
+
+        if synthesizer.random_seed is not None:
+            np.random.seed(synthesizer.random_seed)
+            torch.manual_seed(synthesizer.random_seed)
+        return synthesizer
+
+    def fit(self):
+        # Fit the model to the data
+        self._serialized_model = None
+        self.sdv_synthesizer.fit(self.constraint_layer.fit_transform(self.original_data.to_pandas()))
+        print("Model fitted.")
@@ -0,0 +1,204 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Iterable, NamedTuple
+
+import polars as pl
+from joblib.externals.loky import get_reusable_executor
+
+from data_sampling import save_groups
+from data_synthesis import prepare_groups, synthesize_group
+from src.data.data_models import Data, SparsePeptides
+from src.modeling.bootstrapping_results import bootstrap_synthetic_data
+
+# rough number of copies of a table held while it is parsed, fitted or merged
+_MEMORY_OVERHEAD = 3
+
+
+def finish_dataset(
+        synth_df: list[Data],
+        primary_key: str,
+        save_path: str,
+        bootstrapping: dict[str, Any] | None = None,
+) -> None:
+    """
+    merge and save the synthetic groups of a dataset, then bootstrap them
+    Args:
+        synth_df: postprocessed synthetic groups in the order of the filters
+        primary_key: primary key column name
+        save_path: path to directory where data will be saved
+        bootstrapping: keyword arguments of `bootstrap_synthetic_data` except `save_path`, None to skip it
+    """
+    save_groups(synth_df, None, primary_key, save_path)
+    if bootstrapping is not None:
+        bootstrap_synthetic_data(save_path, **bootstrapping)
+        # idle joblib workers would keep the pool process from exiting at shutdown until they time out
+        get_reusable_executor().shutdown(wait=True)
+
+
+class _Task(NamedTuple):
+    priority: int  # finishing a dataset is started before its groups, groups before loading the next dataset
+    dataset: int
+    group: int | None
+    cpus: int
+    memory: float
+    function: Callable
+    kwargs: dict[str, Any]
+
+
+class SynthesisScheduler:
+    def __init__(self, max_cpus: int | None = None, memory_limit: float | None = None):
+        """
+        scheduler running the synthesis of several datasets and their filter groups concurrently
+        Every dataset is loaded and its marginals are estimated by one task. Afterwards every group is fitted,
+        sampled and postprocessed by an independent task, and the groups of a dataset are merged, saved and
+        bootstrapped as soon as all of them are done, regardless of the other datasets.
+
+        Tasks run on a pool of `max_cpus` processes and are only started while the CPU cores and the
+        memory they are estimated to use fit into the limits. A task using more cores itself, e.g.
+        distribution fitting with several workers, counts as that many cores. Memory is estimated from
+        the size of the input files and tables, a task exceeding the limit on its own runs alone.
+        Args:
+            max_cpus: number of CPU cores used by running tasks, all cores if None
+            memory_limit: estimated memory in GB used by running tasks, not limited if None
+        """
+        self.max_cpus = max_cpus or os.cpu_count()
+        self.memory_limit = memory_limit * 1024 ** 3 if memory_limit is not None else float("inf")
+
+    def run(
+            self,
+            datasets: list[dict[str, Any]],
+            save_paths: list[str],
+            bootstrapping: list[dict[str, Any] | None] | None = None,
+    ) -> None:
+        """
+        synthesize all datasets
+        Args:
+            datasets: keyword arguments of `prepare_groups` for every dataset
+            save_paths: paths to directories where the data of every dataset will be saved
+            bootstrapping: keyword arguments of `bootstrap_synthetic_data` except `save_path` for every dataset,
+                           None to skip bootstrapping
+        """
+        bootstrapping = bootstrapping or [None] * len(datasets)
+        synth_df = {}
+        queue = [
+            _Task(
+                2, i, None, self._cpus(options.get("fitting_workers")), self._prepare_memory(options),
+                prepare_groups, options,
+            )
+            for i, options in enumerate(datasets)
+        ]
+        running = {}
+        # polars is not fork-safe once its thread pool is used, by the tasks or by unpickling their results
+        with ProcessPoolExecutor(max_workers=self.max_cpus, mp_context=multiprocessing.get_context("spawn")) as executor:
+            try:
+                while queue or running:
+                    queue.sort(key=lambda task: (task.priority, task.dataset))
+                    while queue and self._fits(queue[0], running.values()):
+                        task = queue.pop(0)
+                        running[executor.submit(task.function, **task.kwargs)] = task
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = running.pop(future)
+                        result = future.result()
+                        if task.function is prepare_groups:
+                            print(f"Dataset {task.dataset} loaded, scheduling {len(result)} groups.")
+                            synth_df[task.dataset] = [None] * len(result)
+                            queue += [
+                                _Task(
+                                    1, task.dataset, i, self._group_cpus(job), self._group_memory(job),
+                                    synthesize_group, job,
+                                )
+                                for i, job in enumerate(result)
+                            ]
+                        elif task.function is synthesize_group:
+                            print(f"Group {task.group} of dataset {task.dataset} synthesized.")
+                            synth_df[task.dataset][task.group] = result
+                            if all(group is not None for group in synth_df[task.dataset]):
+                                groups = synth_df.pop(task.dataset)
+                                cpus = self.max_cpus if bootstrapping[task.dataset] is not None else 1
+                                queue.append(_Task(
+                                    0, task.dataset, None, cpus, self._finish_memory(groups), finish_dataset,
+                                    {
+                                        "synth_df": groups,
+                                        "primary_key": datasets[task.dataset]["primary_key"],
+                                        "save_path": save_paths[task.dataset],
+                                        "bootstrapping": (
+                                            {**bootstrapping[task.dataset], "n_jobs": cpus}
+                                            if bootstrapping[task.dataset] is not None else None
+                                        ),
+                                    },
+                                ))
+                        else:
+                            print(f"Dataset {task.dataset} finished.")
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    def _fits(self, task: _Task, running: Iterable[_Task]) -> bool:
+        """whether the task can be started next to the running tasks"""
+        running = list(running)
+        if not running:
+            if task.memory > self.memory_limit:
+                print(
+                    f"Task of dataset {task.dataset} is estimated to need {task.memory / 1024 ** 3:.1f} GB, "
+                    "more than the memory limit, it runs alone."
+                )
+            return True
+        return (
+            sum(other.cpus for other in running) + task.cpus <= self.max_cpus
+            and sum(other.memory for other in running) + task.memory <= self.memory_limit
+        )
+
+    def _cpus(self, workers: int | None) -> int:
+        """number of cores used by a task with `workers` processes or threads, all cores if None"""
+        return min(workers or self.max_cpus, self.max_cpus)
+
+    def _group_cpus(self, job: dict[str, Any]) -> int:
+        workers = job["engine_options"].get("n_workers", 1)
+        if job["sampling_shard_size"]:
+            workers = max(workers, job["sampling_workers"])
+        return self._cpus(workers)
+
+    @staticmethod
+    def _prepare_memory(options: dict[str, Any]) -> float:
+        """input files are parsed into tables of roughly their size"""
+        paths = (options["peptide_data_path"], options["clinical_data_path"])
+        return _MEMORY_OVERHEAD * sum(os.path.getsize(path) for path in paths if Path(path).is_file())
+
+    @staticmethod
+    def _group_memory(job: dict[str, Any]) -> float:
+        """
+        the tables of the dataset sent to the task, the modelled table, the copula correlation and the
+        synthetic table with all peptides
+        """
+        data = job["data"]
+        modelled_columns = len(data.clinical.columns) + len(job["peptides_to_model"].columns)
+        all_columns = len(data.clinical.columns) + len(data.peptides.collect_schema())
+        # every task receives a pickled copy of the peptides shared by the groups, held twice while unpickling
+        if isinstance(data.peptides, SparsePeptides):
+            peptides = sum(array.nbytes for array in (data.peptides.values.data, data.peptides.values.indices))
+        elif isinstance(data.peptides, pl.DataFrame):
+            peptides = data.peptides.estimated_size()
+        else:
+            peptides = 0  # a lazy frame is sent as its query
+        shipped = 2 * (data.clinical.estimated_size() + peptides + job["peptides_to_model"].estimated_size())
+        return shipped + 8 * (
+            _MEMORY_OVERHEAD * data.clinical.height * modelled_columns
+            + 2 * modelled_columns ** 2
+            + _MEMORY_OVERHEAD * job["number_of_synth_samples"] * all_columns
+        )
+
+    @staticmethod
+    def _finish_memory(synth_df: list[Data]) -> float:
+        """the merged synthetic tables"""
+        size = 0
+        for data in synth_df:
+            size += data.clinical.estimated_size()
+            if isinstance(data.peptides, SparsePeptides):
+                size += 8 * data.peptides.height * len(data.peptides.columns)
+            else:
+                size += data.peptides.estimated_size()
+        return _MEMORY_OVERHEAD * size